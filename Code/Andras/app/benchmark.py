@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import platform
+import argparse
+import subprocess
+import datetime as dt
+import numpy as np
+import pandas as pd
+import shapely
+import flatbuffers
+import folium
+import xgboost
+import streamlit as st
+from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
+import functions
+from map_layers import add_prediction_layer
+from hourly_features import SOURCE_COLUMNS
+
+# Offline benchmarks of the prediction path, e.g.:
+#     python Code/Andras/app/benchmark.py run --cells 1000 100000 1000000
+#     python Code/Andras/app/benchmark.py compare old.json new.json
+# Run from the repository root, like the app.
+
+BENCHMARK_DIR = "Code/Andras/benchmarks"
+RECORDING_DIR = os.path.join(BENCHMARK_DIR, "recordings")
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+WORK_DIR = os.path.join(BENCHMARK_DIR, "work")
+
+# The models, relative to a benchmark root (linked to the real ones)
+MODEL_DIR = "Code/Andras"
+
+# Forecast request that is recorded and replayed
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+FORECAST_DAYS = 16
+
+# Grid attributes the damage models use, with the ranges the synthetic grid draws from
+GRID_ATTRIBUTES = {'building_area': (0, 10_000), 'average_building_age': (0, 120), 'trees': (0, 60)}
+
+# Grid cell size (m) and origin of the synthetic grid in RD New (epsg:28992)
+CELL_SIZE = 100
+GRID_ORIGIN = (110_000, 476_000)
+
+# A benchmark that got this much slower than the baseline counts as a regression
+REGRESSION_RATIO = 1.2
+
+# Open-Meteo variable codes of the recorded parameters (openmeteo_sdk Variable enum)
+VARIABLE_CODES = {'precipitation': 24, 'wind_speed_10m': 59, 'wind_gusts_10m': 58}
+
+
+def recording_path(name):
+
+    return os.path.join(RECORDING_DIR, f'{name}.bin')
+
+
+def record_forecast(list_of_parameters=SOURCE_COLUMNS):
+
+    # Store the raw FlatBuffers body of a real forecast response (needs network access)
+    from openmeteo_cache import cache_session
+    params = {"latitude": 52.374, "longitude": 4.890, "hourly": ','.join(list_of_parameters),
+              "timezone": "Europe/Berlin", "forecast_days": FORECAST_DAYS, "past_days": 0, "format": "flatbuffers"}
+    response = cache_session.get(FORECAST_URL, params=params, expire_after=0)
+    response.raise_for_status()
+
+    os.makedirs(RECORDING_DIR, exist_ok=True)
+    with open(recording_path('forecast'), 'wb') as recording:
+        recording.write(response.content)
+
+    return recording_path('forecast')
+
+
+def synthetic_forecast(list_of_parameters=SOURCE_COLUMNS, hours=FORECAST_DAYS * 24, seed=0):
+
+    # A forecast body in the Open-Meteo FlatBuffers format, for when nothing has been recorded.
+    # Field slots follow the openmeteo_sdk schema (VariableWithValues, VariablesWithTime, WeatherApiResponse).
+    rng = np.random.default_rng(seed)
+    builder = flatbuffers.Builder(hours * 4 * len(list_of_parameters) + 1024)
+    start = int(pd.Timestamp(dt.date.today()).timestamp())
+
+    variables = []
+    for parameter in list_of_parameters:
+        values = (rng.gamma(1.0, 5.0, hours) if 'wind' in parameter else rng.exponential(0.3, hours))
+        vector = builder.CreateNumpyVector(values.astype(np.float32))
+        builder.StartObject(14)
+        builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+        builder.PrependUint8Slot(0, VARIABLE_CODES.get(parameter, 0), 0)
+        variables.append(builder.EndObject())
+
+    builder.StartVector(4, len(variables), 4)
+    for variable in reversed(variables):
+        builder.PrependUOffsetTRelative(variable)
+    variable_vector = builder.EndVector()
+
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start, 0)
+    builder.PrependInt64Slot(1, start + hours * 3600, 0)
+    builder.PrependInt32Slot(2, 3600, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variable_vector, 0)
+    hourly = builder.EndObject()
+
+    builder.StartObject(15)
+    builder.PrependFloat32Slot(0, 52.374, 0)
+    builder.PrependFloat32Slot(1, 4.890, 0)
+    builder.PrependUOffsetTRelativeSlot(11, hourly, 0)
+    builder.Finish(builder.EndObject())
+
+    # Responses are length-prefixed messages
+    body = bytes(builder.Output())
+
+    return len(body).to_bytes(4, 'little') + body
+
+
+def forecast_body():
+
+    # The recorded response when there is one, the synthetic one otherwise
+    if os.path.exists(recording_path('forecast')):
+        with open(recording_path('forecast'), 'rb') as recording:
+            return recording.read(), 'recorded'
+
+    return synthetic_forecast(), 'synthetic'
+
+
+def decode_messages(body):
+
+    # Same framing as the openmeteo_requests client: 4 byte length, then one message
+    messages = []
+    position = 0
+    while position < len(body):
+        length = int.from_bytes(body[position:position + 4], byteorder='little')
+        messages.append(WeatherApiResponse.GetRootAs(body, position + 4))
+        position += length + 4
+
+    return messages
+
+
+def replay_weather_api(body):
+
+    # Stands in for openmeteo_cache.weather_api: decodes the stored body on every call
+    return lambda url, params, expire_after=None: decode_messages(body)
+
+
+def synthetic_history(days=8, seed=1):
+
+    # Hourly history in the layout of archived_historical_data
+    rng = np.random.default_rng(seed)
+    timestamps = pd.date_range(pd.Timestamp(dt.date.today()) - pd.Timedelta(days=days), periods=days * 24, freq='h')
+
+    return pd.DataFrame({'timestamp': timestamps,
+                         'precipitation': rng.exponential(0.3, len(timestamps)).astype(np.float32),
+                         'wind_speed_10m': rng.gamma(1.0, 5.0, len(timestamps)).astype(np.float32),
+                         'wind_gusts_10m': rng.gamma(1.5, 6.0, len(timestamps)).astype(np.float32)})
+
+
+def write_synthetic_grid(root, n_cells, seed=0):
+
+    # model_data.sqlite with a square grid of n_cells cells and four service areas
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_cells)))
+    rows, columns = np.divmod(np.arange(n_cells), side)
+    x = GRID_ORIGIN[0] + columns * CELL_SIZE
+    y = GRID_ORIGIN[1] + rows * CELL_SIZE
+    cells = shapely.box(x, y, x + CELL_SIZE, y + CELL_SIZE)
+
+    grid = pd.DataFrame({name: rng.uniform(low, high, n_cells) for name, (low, high) in GRID_ATTRIBUTES.items()})
+    grid['geometry'] = shapely.to_wkt(cells, rounding_precision=1)
+    grid['geometry' + functions.WKB_SUFFIX] = shapely.to_wkb(cells)
+
+    # Four quadrants as service areas, with the station in the middle of each
+    extent = side * CELL_SIZE
+    half = extent / 2
+    areas = [shapely.box(GRID_ORIGIN[0] + i * half, GRID_ORIGIN[1] + j * half,
+                         GRID_ORIGIN[0] + (i + 1) * half, GRID_ORIGIN[1] + (j + 1) * half)
+             for i in range(2) for j in range(2)]
+    stations = pd.DataFrame({'Service area': list('ABCD'), 'gemeente': 'Amsterdam', 'Vehicle Count': 2,
+                             'Firestation location': shapely.to_wkt(shapely.centroid(areas)),
+                             'Service area geometry': shapely.to_wkt(areas)})
+
+    database_path = os.path.join(root, "Code/data/model_data.sqlite")
+    os.makedirs(os.path.dirname(database_path), exist_ok=True)
+    if os.path.exists(database_path):
+        os.remove(database_path)
+    with sqlite3.connect(database_path) as conn:
+        grid.to_sql('AMS_grid_blocks', conn, index=False)
+        stations.to_sql('Firestations', conn, index=False)
+
+    # The functions load the models from Code/Andras relative to the working directory
+    model_link = os.path.join(root, MODEL_DIR)
+    if not os.path.exists(model_link):
+        os.symlink(os.path.abspath(MODEL_DIR), model_link)
+
+
+def timed(run, repeats):
+
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - start)
+
+    return timings, result
+
+
+def measure(results, name, run, repeats, **info):
+
+    # One entry per benchmark; a failing benchmark is recorded instead of stopping the suite
+    try:
+        timings, result = timed(run, repeats)
+    except Exception as error:
+        results.append({'name': name, **info, 'error': f'{type(error).__name__}: {error}'})
+        print(f'{name:<24} {info}  FAILED {type(error).__name__}: {error}')
+        return None
+
+    results.append({'name': name, **info, 'repeats': repeats,
+                    'seconds_min': min(timings), 'seconds_median': float(np.median(timings))})
+    print(f'{name:<24} {info}  {min(timings) * 1000:10.1f} ms')
+
+    return result
+
+
+def clear_caches():
+
+    # Every repeat measures the work, not a Streamlit cache hit
+    st.cache_data.clear()
+    st.cache_resource.clear()
+
+
+def run_suite(grid_sizes, repeats=3):
+
+    body, source = forecast_body()
+    functions.weather_api = replay_weather_api(body)
+    history = synthetic_history()
+    results = []
+
+    def uncached(function, *args):
+        clear_caches()
+        return function(*args)
+
+    # Weather part, independent of the grid size
+    forecast = measure(results, 'decode_forecast', lambda: uncached(functions.openmeteo_forecast_data),
+                       repeats, source=source, bytes=len(body))
+    measure(results, 'convert_to_daily', lambda: uncached(functions.convert_to_daily, forecast), repeats,
+            hours=len(forecast))
+    predictors = measure(results, 'openmeteo_predictors',
+                         lambda: functions.openmeteo_predictors(history, forecast), repeats, hours=len(forecast))
+
+    repo_root = os.getcwd()
+    for n_cells in grid_sizes:
+        root = os.path.abspath(os.path.join(WORK_DIR, f'grid_{n_cells}'))
+        write_synthetic_grid(root, n_cells)
+        os.chdir(root)
+        clear_caches()
+        try:
+            predictions = measure(results, 'predict_future_damage',
+                                  lambda: functions.predict_future_damage(predictors), repeats,
+                                  cells=n_cells, days=len(predictors))
+            measure(results, 'predict_manual_damage',
+                    lambda: uncached(functions.predict_manual_damage, 1, 10, 8, 25, 2, 9, 30), repeats, cells=n_cells)
+
+            if predictions is not None:
+                day = predictions[predictions['date'] == predictions['date'].iloc[0]].drop(columns='date')
+                measure(results, 'attach_grid_geometry', lambda: functions.attach_grid_geometry(day), repeats,
+                        cells=n_cells)
+                measure(results, 'folium_serialization',
+                        lambda: add_prediction_layer(folium.Map(location=(52.36, 4.886)), day, 'building_proba',
+                                                     'Building damage prediction').get_root().render(),
+                        repeats, cells=n_cells)
+        finally:
+            os.chdir(repo_root)
+
+    return results
+
+
+def environment():
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {'commit': commit, 'created': dt.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'xgboost': xgboost.__version__}
+
+
+def save_results(results, output=None):
+
+    report = {'environment': environment(), 'results': results}
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f'{dt.datetime.now():%Y%m%d-%H%M%S}_{report["environment"]["commit"] or "nogit"}.json')
+    with open(output, 'w') as results_file:
+        json.dump(report, results_file, indent=1)
+
+    return output
+
+
+def benchmark_key(entry):
+
+    # Benchmarks are matched by name and size
+    return (entry['name'], entry.get('cells'))
+
+
+def compare(baseline_path, current_path, ratio=REGRESSION_RATIO):
+
+    with open(baseline_path) as baseline_file, open(current_path) as current_file:
+        baseline = {benchmark_key(entry): entry for entry in json.load(baseline_file)['results']}
+        current = {benchmark_key(entry): entry for entry in json.load(current_file)['results']}
+
+    regressions = []
+    for key, entry in current.items():
+        if key not in baseline or 'seconds_min' not in entry or 'seconds_min' not in baseline[key]:
+            continue
+        change = entry['seconds_min'] / baseline[key]['seconds_min']
+        flag = 'REGRESSION' if change > ratio else ''
+        print(f'{key[0]:<24} {str(key[1] or ""):>8}  {baseline[key]["seconds_min"] * 1000:10.1f} ms'
+              f' -> {entry["seconds_min"] * 1000:10.1f} ms  x{change:5.2f} {flag}')
+        if flag:
+            regressions.append(key)
+
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the storm damage prediction path')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--cells', type=int, nargs='+', default=[1_000, 10_000])
+    run_parser.add_argument('--repeats', type=int, default=3)
+    run_parser.add_argument('--output')
+
+    commands.add_parser('record')
+
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--ratio', type=float, default=REGRESSION_RATIO)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        print(record_forecast())
+    elif args.command == 'run':
+        print(save_results(run_suite(args.cells, args.repeats), args.output))
+    else:
+        sys.exit(1 if compare(args.baseline, args.current, args.ratio) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+from openmeteo_sdk.Variable import Variable
+from functions import iter_future_damage, daily_aggregate, total_probability
+from hourly_features import window_sums
+from prediction_index import PredictionIndex, PROBA_COLUMNS
+from openmeteo_cache import weather_api, forecast_expiry
+from instrumentation import traced, span
+
+ENSEMBLE_URL = "https://ensemble-api.open-meteo.com/v1/ensemble"
+
+# ECMWF IFS 0.25 ensemble: 51 members, 15 days ahead
+ENSEMBLE_MODEL = "ecmwf_ifs025"
+
+# Days scored per run, the date picker offers today up to a week ahead
+ENSEMBLE_DAYS = 8
+
+# Source variables and how the ensemble API labels them (variable, altitude in metres)
+ENSEMBLE_VARIABLES = {'precipitation': (Variable.precipitation, 0),
+                      'wind_speed_10m': (Variable.wind_speed, 10),
+                      'wind_gusts_10m': (Variable.wind_gusts, 10)}
+
+# Bands of the member spread per cell and day
+ENSEMBLE_QUANTILES = {'p10': 0.1, 'p50': 0.5, 'p90': 0.9}
+
+# Share of members with a damage probability of at least this much
+EXCEEDANCE_THRESHOLDS = [0.1, 0.25, 0.5]
+
+
+@traced
+def openmeteo_ensemble_data(future_days=ENSEMBLE_DAYS, past_days=0):
+
+    # Hourly values of every member, as (members x hours) arrays per source variable
+    params = {
+        "latitude": 52.374,
+        "longitude": 4.890,
+        "hourly": list(ENSEMBLE_VARIABLES),
+        "models": ENSEMBLE_MODEL,
+        "wind_speed_unit": "ms",
+        "timezone": "Europe/Berlin",
+        "forecast_days": future_days,
+        "past_days": past_days,
+    }
+    response = weather_api(ENSEMBLE_URL, params, expire_after=forecast_expiry())[0]
+    hourly = response.Hourly()
+
+    timestamps = pd.date_range(start=pd.to_datetime(hourly.Time(), unit="s"),
+                               end=pd.to_datetime(hourly.TimeEnd(), unit="s"),
+                               freq=pd.Timedelta(seconds=hourly.Interval()),
+                               inclusive="left")
+
+    # Every (variable, member) pair comes as its own series, the order is not fixed
+    labels = {label: name for name, label in ENSEMBLE_VARIABLES.items()}
+    members = {name: {} for name in ENSEMBLE_VARIABLES}
+    for i in range(hourly.VariablesLength()):
+        variable = hourly.Variables(i)
+        name = labels.get((variable.Variable(), variable.Altitude()))
+        if name is not None:
+            members[name][variable.EnsembleMember()] = variable.ValuesAsNumpy()
+
+    ensemble = {'timestamp': timestamps}
+    for name, series in members.items():
+        ensemble[name] = np.stack([series[member] for member in sorted(series)]).astype(np.float64)
+
+    return ensemble
+
+
+# Daily predictors from the hourly values, as in openmeteo_predictors
+ENSEMBLE_DAILY_AGGREGATIONS = {'precipitation': ('precipitation', 'sum'),
+                               'Average hourly wind speed (m/s)': ('wind_speed_10m', 'mean'),
+                               'Maximum hourly wind speed (m/s)': ('wind_gusts_10m', 'max')}
+
+
+@traced
+def ensemble_predictors(hist_result, ensemble, days=ENSEMBLE_DAYS):
+
+    # openmeteo_predictors for every member at once: the observed history is shared, each
+    # member continues it with its own forecast. Rows are member-major (member, date).
+    hist_result = hist_result.dropna()
+    n_members = len(ensemble['precipitation'])
+
+    # The members' past days only fill the hours after the last measured hour
+    after = np.asarray(ensemble['timestamp'] > hist_result['timestamp'].max())
+    ensemble = {name: values[after] if name == 'timestamp' else values[:, after] for name, values in ensemble.items()}
+
+    # One hourly series per member, aggregated to days for all members at once
+    timestamps = np.concatenate([hist_result['timestamp'].to_numpy(), ensemble['timestamp'].to_numpy()])
+    hourly = pd.DataFrame({'member': np.repeat(np.arange(n_members), len(timestamps)),
+                           'timestamp': np.tile(timestamps, n_members)})
+    for name in ENSEMBLE_VARIABLES:
+        history = np.broadcast_to(hist_result[name].to_numpy(np.float64), (n_members, len(hist_result)))
+        hourly[name] = np.concatenate([history, ensemble[name]], axis=1).ravel()
+    daily_df = daily_aggregate(hourly, ENSEMBLE_DAILY_AGGREGATIONS, by='member')
+
+    # (members x days) per predictor
+    daily = {column: daily_df[column].unstack('date') for column in ENSEMBLE_DAILY_AGGREGATIONS}
+    dates = pd.DatetimeIndex(daily['precipitation'].columns)
+    daily = {column: values.to_numpy(np.float64) for column, values in daily.items()}
+
+    # Trailing windows over the days of every member, NaN like rolling(window)
+    daily['Precipitation past two week'] = np.stack([window_sums(values, 14) for values in daily['precipitation']])
+    daily['Average wind past three days'] = np.stack([window_sums(values, 3) / 3
+                                                      for values in daily['Average hourly wind speed (m/s)']])
+
+    # From today, the scored days only
+    keep = np.flatnonzero(dates >= pd.Timestamp(dt.date.today()))[:days]
+
+    features = pd.DataFrame({'member': np.repeat(np.arange(n_members), len(keep)),
+                             'date': np.tile(dates[keep].date, n_members)})
+    for column, values in daily.items():
+        features[column] = values[:, keep].ravel()
+    features['Leaves on or not'] = np.tile(dates[keep].month.isin([4, 5, 6, 7, 8, 9]).astype(int), n_members)
+
+    return features
+
+
+@traced
+def score_ensemble(features):
+
+    # All members x days x cells in the one cross join of iter_future_damage, chunked only by
+    # its memory budget, then reduced over the members per cell and day
+    n_members = features['member'].nunique()
+    n_days = len(features) // n_members
+    days = features['date'].iloc[:n_days].to_numpy()
+
+    scored = {column: [] for column in PROBA_COLUMNS}
+    for chunk in iter_future_damage(features.drop(columns='member')):
+        for column in PROBA_COLUMNS:
+            scored[column].append(chunk[column].to_numpy(np.float32))
+
+    # Scored cell-major over the (member, day) rows -> (members x days x cells)
+    members = {column: np.concatenate(scored[column]).reshape(-1, n_members, n_days).transpose(1, 2, 0)
+               for column in PROBA_COLUMNS}
+    members['total_proba'] = total_probability(members['building_proba'], members['tree_proba'])
+
+    with span('ensemble_reduce'):
+        bands = ensemble_bands(members)
+
+    return {band: PredictionIndex(days, arrays) for band, arrays in bands.items()}
+
+
+def ensemble_bands(members):
+
+    # (members x days x cells) per column -> (days x cells) per band and column
+    bands = {band: {} for band in list(ENSEMBLE_QUANTILES) + [exceedance_band(t) for t in EXCEEDANCE_THRESHOLDS]}
+    for column, values in members.items():
+        quantiles = np.quantile(values, list(ENSEMBLE_QUANTILES.values()), axis=0).astype(np.float32)
+        for band, band_values in zip(ENSEMBLE_QUANTILES, quantiles):
+            bands[band][column] = band_values
+        for threshold in EXCEEDANCE_THRESHOLDS:
+            bands[exceedance_band(threshold)][column] = (values >= threshold).mean(axis=0, dtype=np.float32)
+
+    return bands
+
+
+def exceedance_band(threshold):
+
+    return f'P(>={threshold:g})'
@@ -1,21 +1,16 @@
-import openmeteo_requests
-import requests_cache
 import pandas as pd
 import numpy as np
-from retry_requests import retry
 import datetime as dt
-import streamlit as st
 import sqlite3
 import geopandas as gpd
-from shapely import wkt
-import calendar
-import pickle
-from itertools import product
-
-# Setup the Open-Meteo API client with cache and retry on error
-cache_session = requests_cache.CachedSession('.cache', expire_after = -1)
-retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
-openmeteo = openmeteo_requests.Client(session = retry_session)
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from model_registry import get_pipeline
+from scoring import get_scorer
+from openmeteo_cache import weather_api, forecast_expiry, archive_expiry
+from instrumentation import cached, traced, span
+from static_snapshot import snapshot_table
+from migrate_geometry_wkb import WKB_SUFFIX
 
 current_parameters = ["temperature_2m", "precipitation", "rain", "showers", "snowfall", 
                         "surface_pressure", "wind_speed_10m", "wind_direction_10m", 
@@ -35,31 +30,52 @@ historical_parameters = ["temperature_2m", "precipitation", "rain", "snowfall",
                             "soil_moisture_0_to_7cm", "soil_moisture_7_to_28cm", "soil_moisture_28_to_100cm", 
                             "soil_moisture_100_to_255cm"]
 
+# Coordinates per Open-Meteo request and number of requests in flight
+OPENMETEO_BATCH_SIZE = 50
+OPENMETEO_MAX_WORKERS = 4
+
+# Upper bound for the working memory of one prediction chunk
+DEFAULT_MEMORY_BUDGET_MB = 256
+
+# Aggregations of convert_to_daily: output name -> (hourly column, how)
+DAILY_AGGREGATIONS = {'avg_precipitation': ('precipitation', 'mean'),
+                      'avg_windspeed': ('wind_speed_10m', 'mean'),
+                      'max_windspeed': ('wind_speed_10m', 'max'),
+                      'avg_strong_windspeed': ('wind_speed_10m', ('fraction_above', 15))}
+
 
 
-@st.cache_data
 def openmeteo_historical_data(list_of_parameters=['precipitation', 'wind_speed_10m', 'wind_gusts_10m'], 
                               start_date = '2024-01-01', 
-                              end_date = str(dt.date.today())):
+                              end_date = None):
+
+    # Resolve the default end date per call, before the cache, so it is part of the cache key
+    if end_date is None:
+        end_date = str(dt.date.today())
 
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession('.cache', expire_after = -1)
-    retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
-    openmeteo = openmeteo_requests.Client(session = retry_session)
+    return cached_historical_data(list_of_parameters, start_date, end_date)
+
+@cached
+def cached_historical_data(list_of_parameters, start_date, end_date):
+
+    return fetch_openmeteo_historical(list_of_parameters, start_date, end_date)
+
+@traced
+def fetch_openmeteo_historical(list_of_parameters, start_date, end_date, latitude=52.374, longitude=4.890):
 
     # Make sure all required weather variables are listed here
     # The order of variables in hourly or daily is important to assign them correctly below
     url = "https://archive-api.open-meteo.com/v1/archive"
     params = {
-        "latitude": 52.374,
-        "longitude": 4.890,
+        "latitude": latitude,
+        "longitude": longitude,
         "start_date": start_date,
         "end_date": end_date,
         "hourly": list_of_parameters,
         "wind_speed_unit": "ms",
         "timezone": "Europe/Berlin"
     }
-    responses = openmeteo.weather_api(url, params=params)
+    responses = weather_api(url, params, expire_after=archive_expiry(end_date))
     response = responses[0]
     hourly = response.Hourly()
     
@@ -78,7 +94,9 @@ def openmeteo_historical_data(list_of_parameters=['precipitation', 'wind_speed_1
         
     return historical_data
 
-@st.cache_data
+# Not behind st.cache_data: a cache without the forecast run in its key would keep serving
+# the first run. The forecast stages cache it per run, the HTTP cache until the next run.
+@traced
 def openmeteo_forecast_data(list_of_parameters=['precipitation', 'wind_speed_10m', 'wind_gusts_10m'], past_days=0, future_days=16):
 
     url = "https://api.open-meteo.com/v1/forecast"
@@ -86,11 +104,12 @@ def openmeteo_forecast_data(list_of_parameters=['precipitation', 'wind_speed_10m
         "latitude": 52.374,
         "longitude": 4.890,
         "hourly": list_of_parameters,
+        "wind_speed_unit": "ms",
         "timezone": "Europe/Berlin",
         "forecast_days": future_days,
         "past_days": past_days
     }
-    responses = openmeteo.weather_api(url, params=params)
+    responses = weather_api(url, params, expire_after=forecast_expiry())
     response = responses[0]
     hourly = response.Hourly()
     
@@ -109,41 +128,193 @@ def openmeteo_forecast_data(list_of_parameters=['precipitation', 'wind_speed_10m
         
     return forecast_data
  
-@st.cache_data
-def convert_to_daily(result):
-
-    # add column that transforms the timestamp in just the date
-    result['date'] = result['timestamp'].dt.date
-
-    # move column 'date' to the left of the dataframe (this is purely for aesthetic reasons)
-    cols = list(result)
-    cols.insert(0, cols.pop(cols.index('date')))
-    result = result.loc[:, cols]    
+@traced
+def decode_hourly_responses(responses, location_names, list_of_parameters):
+
+    # Stack the hourly values of every location into one (location x variable x time) block
+    timestamps = []
+    blocks = []
+    for response in responses:
+        hourly = response.Hourly()
+        timestamps.append(pd.date_range(
+            start = pd.to_datetime(hourly.Time(), unit = "s"),
+            end = pd.to_datetime(hourly.TimeEnd(), unit = "s"),
+            freq = pd.Timedelta(seconds = hourly.Interval()),
+            inclusive = "left"))
+        blocks.append(np.stack([hourly.Variables(i).ValuesAsNumpy() for i in range(len(list_of_parameters))]))
+
+    n_times = len(timestamps[0])
+    n_variables = len(list_of_parameters)
+    values = np.stack(blocks)
+
+    # Long format: one row per location, variable and hour
+    location_data = pd.DataFrame({
+        "location": pd.Categorical(np.repeat(location_names, n_variables * n_times), categories=location_names),
+        "variable": pd.Categorical(np.tile(np.repeat(list_of_parameters, n_times), len(blocks)), categories=list_of_parameters),
+        "timestamp": np.tile(timestamps[0].to_numpy(), len(blocks) * n_variables),
+        "value": values.ravel()})
+
+    return location_data
+
+@traced
+def openmeteo_multi_location(url, locations, params, list_of_parameters, expire_after,
+                             batch_size=OPENMETEO_BATCH_SIZE, max_workers=OPENMETEO_MAX_WORKERS):
+
+    # Open-Meteo accepts a list of coordinates per request and answers with one response per coordinate
+    def fetch(batch):
+        batch_params = dict(params,
+                            latitude=batch["latitude"].round(4).tolist(),
+                            longitude=batch["longitude"].round(4).tolist(),
+                            hourly=list_of_parameters)
+        return weather_api(url, batch_params, expire_after)
+
+    batches = [locations.iloc[i:i + batch_size] for i in range(0, len(locations), batch_size)]
+
+    # Run the batches concurrently, the responses come back in location order
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = [response for batch_responses in executor.map(fetch, batches) for response in batch_responses]
+
+    return decode_hourly_responses(responses, locations["location"].tolist(), list_of_parameters)
+
+@traced
+def service_area_locations(database_path):
+
+    # Centroid of every fire service area in lat/lon
+    _, service_areas = get_firestation_data(database_path)
+    centroids = service_areas.geometry.centroid.to_crs("epsg:4326")
+
+    return pd.DataFrame({"location": service_areas["Service area"].astype(str).to_numpy(),
+                         "latitude": centroids.y.to_numpy(),
+                         "longitude": centroids.x.to_numpy()})
+
+# Not behind st.cache_data, the forecast stages cache it per forecast run
+@traced
+def openmeteo_forecast_locations(locations, list_of_parameters=['precipitation', 'wind_speed_10m', 'wind_gusts_10m'], past_days=0, future_days=16):
 
-    # group by date
-    grouped_result = result.groupby('date')
-
-    # average precipitation (grouped by date)
-    avg_precipitation_daily = grouped_result["precipitation"].mean()
-
-    # average wind speed (grouped by date)
-    avg_windspeed_daily = grouped_result["wind_speed_10m"].mean()
-
-    # max wind speed (grouped by date)
-    max_windspeed_daily = grouped_result["wind_speed_10m"].max()
+    params = {
+        "wind_speed_unit": "ms",
+        "timezone": "Europe/Berlin",
+        "forecast_days": future_days,
+        "past_days": past_days
+    }
 
-    # average strong wind (>15 m/s) (grouped by date)
-    avg_strong_windspeed_daily = grouped_result["wind_speed_10m"].apply(lambda x: np.average(x > 15))
+    return openmeteo_multi_location("https://api.open-meteo.com/v1/forecast", locations, params, list_of_parameters,
+                                    forecast_expiry())
+
+@traced
+def regular_hourly_blocks(result, by):
+
+    # Returns the timestamps of one block if every group is the same regular hourly
+    # series (one row per hour, no gaps, same hours in every group), otherwise None.
+    # Time zone aware timestamps are taken as local wall-clock time, so days are split on
+    # local midnight and a DST change (a missing or repeated hour) is not regular.
+    timestamps = result['timestamp']
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_localize(None)
+    timestamps = timestamps.to_numpy(dtype='datetime64[ns]')
+    n_groups = result[by].nunique() if by is not None else 1
+    if len(timestamps) == 0 or len(timestamps) % n_groups:
+        return None
+
+    blocks = timestamps.reshape(n_groups, -1)
+    if not (blocks == blocks[0]).all():
+        return None
+    if len(blocks[0]) > 1 and not (np.diff(blocks[0]) == np.timedelta64(1, 'h')).all():
+        return None
+
+    return blocks[0]
+
+@traced
+def reduce_days(days, present, how):
+
+    # days: (..., n_days, 24) values, present: rows that exist in the input (not padding)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if how == 'mean':
+            return np.nansum(days, axis=-1) / (~np.isnan(days)).sum(axis=-1)
+        if how == 'max':
+            return np.fmax.reduce(days, axis=-1)
+        if how == 'min':
+            return np.fmin.reduce(days, axis=-1)
+        if how == 'sum':
+            return np.nansum(days, axis=-1)
+        if how[0] == 'fraction_above':
+            # Share of the day's rows above the threshold, missing values count as not above
+            return (days > how[1]).sum(axis=-1) / present.sum(axis=-1)
+        if how[0] == 'quantile':
+            return np.nanquantile(days, how[1], axis=-1)
+
+    raise ValueError(f'Unknown daily aggregation: {how}')
+
+@traced
+def daily_aggregate_groupby(result, aggregations, by):
+
+    # Fallback for ragged series (gaps, DST-shifted local days): plain groupby aggregations
+    dates = result['timestamp'].dt.date.rename('date')
+    keys = ([result[by]] if by is not None else []) + [dates]
+    grouped = result.groupby(keys, observed=True)
+
+    daily = {}
+    for name, (column, how) in aggregations.items():
+        if how in ('mean', 'max', 'min', 'sum'):
+            daily[name] = grouped[column].agg(how)
+        elif how[0] == 'fraction_above':
+            # Missing values count as not above, like np.average(x > threshold)
+            daily[name] = (result[column] > how[1]).groupby(keys, observed=True).mean()
+        elif how[0] == 'quantile':
+            daily[name] = grouped[column].quantile(how[1])
+        else:
+            raise ValueError(f'Unknown daily aggregation: {how}')
+
+    return pd.DataFrame(daily)
+
+@traced
+def daily_aggregate(result, aggregations, by=None):
+
+    # aggregations: output name -> (column, how), with how one of 'mean', 'max', 'min',
+    # 'sum', ('fraction_above', threshold) or ('quantile', q)
+    if by is not None:
+        result = result.sort_values([by, 'timestamp'], kind='stable')
+    hours = regular_hourly_blocks(result, by)
+    if hours is None:
+        return daily_aggregate_groupby(result, aggregations, by)
+
+    # Pad the series to whole days, so it can be reshaped into a (days x 24) array
+    first_day = hours[0].astype('datetime64[D]')
+    offset = int((hours[0] - first_day) // np.timedelta64(1, 'h'))
+    n_days = -(-(offset + len(hours)) // 24)
+    groups = result[by].unique() if by is not None else [None]
+
+    columns = list(dict.fromkeys(column for column, _ in aggregations.values()))
+    values = np.full((len(columns), len(groups), n_days * 24), np.nan)
+    for k, column in enumerate(columns):
+        values[k, :, offset:offset + len(hours)] = result[column].to_numpy(dtype=np.float64).reshape(len(groups), -1)
+    present = np.zeros((len(groups), n_days * 24), dtype=bool)
+    present[:, offset:offset + len(hours)] = True
+
+    values = values.reshape(len(columns), len(groups), n_days, 24)
+    present = present.reshape(len(groups), n_days, 24)
+
+    # Every aggregation runs over all groups and days at once
+    daily = {name: reduce_days(values[columns.index(column)], present, how).ravel()
+             for name, (column, how) in aggregations.items()}
+
+    dates = pd.date_range(pd.Timestamp(first_day), periods=n_days, freq='D').date
+    if by is None:
+        index = pd.Index(dates, name='date')
+    else:
+        index = pd.MultiIndex.from_product([groups, dates], names=[by, 'date'])
+
+    return pd.DataFrame(daily, index=index)
+
+@cached
+def convert_to_daily(result):
 
-    # make a dataframe with the results
-    df_results_daily = pd.DataFrame({'avg_precipitation': avg_precipitation_daily,
-                            'avg_windspeed': avg_windspeed_daily,
-                            'max_windspeed': max_windspeed_daily,
-                            'avg_strong_windspeed': avg_strong_windspeed_daily})
+    # Daily averages, maximum and share of strong wind (>15 m/s) hours, grouped by date
+    df_results_daily = daily_aggregate(result, DAILY_AGGREGATIONS)
 
     return df_results_daily
 
-@st.cache_data
+@traced
 def openmeteo_predictors(hist_result, forecast_result):
     '''Prep data'''
 
@@ -153,6 +324,9 @@ def openmeteo_predictors(hist_result, forecast_result):
     # find datetime of the last entry in the historical data
     last_entry=hist_result.index[-1]
 
+    # the forecast (which may include past days) only continues after the last measured hour
+    forecast_result = forecast_result[forecast_result['timestamp'] > hist_result['timestamp'].max()]
+
     '''Forecast -> Hourly + Hourly Rolling'''
 
     # concatenating the past and future values
@@ -183,20 +357,52 @@ def openmeteo_predictors(hist_result, forecast_result):
     return df_complete
 
 
-@st.cache_data
+@traced
+def read_geometry_table(database_path, table, columns, geometry_columns):
+
+    # Served from the memory-mapped snapshot of the static tables (see static_snapshot.py)
+    # while it matches the database file
+    table_data = snapshot_table(database_path, table, columns, geometry_columns)
+    if table_data is not None:
+        return table_data
+
+    # Load only the requested columns from the SQLite database
+    with sqlite3.connect(database_path) as conn:
+        available = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+        # Prefer the WKB copy of a geometry column (see migrate_geometry_wkb.py) over WKT text
+        sources = {}
+        for column in geometry_columns:
+            sources[column] = column + WKB_SUFFIX if column + WKB_SUFFIX in available else column
+
+        selected = list(columns) + list(sources.values())
+        query = 'SELECT ' + ', '.join(f'"{c}"' for c in selected) + f' FROM "{table}"'
+        table_data = pd.read_sql(query, conn)
+
+    # Convert geometry from WKB/text to objects in one vectorized call per column
+    for column, source in sources.items():
+        values = table_data.pop(source).to_numpy()
+        if source.endswith(WKB_SUFFIX):
+            table_data[column] = shapely.from_wkb(values)
+        else:
+            table_data[column] = shapely.from_wkt(values)
+
+    return table_data
+
+@traced
 def get_firestation_data(database_path):
     
-    # Load data from SQLite database
-    with sqlite3.connect(database_path) as conn:
-        firestation_data = pd.read_sql('SELECT * FROM Firestations', conn)
+    # Load the station attributes and both geometry columns
+    firestation_data = read_geometry_table(database_path, 'Firestations',
+                                           ['Service area', 'gemeente', 'Vehicle Count'],
+                                           ['Firestation location', 'Service area geometry'])
     
     # Select relevant columns
-    firestations = firestation_data[['Service area', 'gemeente', 'Vehicle Count']]
-    service_areas = firestation_data[['Service area', 'gemeente']]
+    firestations = firestation_data[['Service area', 'gemeente', 'Vehicle Count']].copy()
+    service_areas = firestation_data[['Service area', 'gemeente']].copy()
     
-    # Convert geometry from text to object
-    firestations['geometry'] = firestation_data['Firestation location'].apply(wkt.loads)
-    service_areas['geometry'] = firestation_data['Service area geometry'].apply(wkt.loads)
+    firestations['geometry'] = firestation_data['Firestation location']
+    service_areas['geometry'] = firestation_data['Service area geometry']
     
     firestations_gdf = gpd.GeoDataFrame(firestations, crs='epsg:28992')
     service_areas_gdf = gpd.GeoDataFrame(service_areas, crs='epsg:28992')
@@ -204,41 +410,46 @@ def get_firestation_data(database_path):
     return firestations_gdf, service_areas_gdf
 
 
-@st.cache_data
-def get_ams_base_grid_data(database_path):
+# Not behind st.cache_data: every cache hit would be a private copy of the grid, while the
+# snapshot columns are memory maps shared by all sessions and worker processes
+@traced
+def get_ams_base_grid_data(database_path, columns=None, geometry=True):
 
-    # Load data from SQLite database
-    with sqlite3.connect(database_path) as conn:
-        ams_grid_data = pd.read_sql('SELECT * FROM AMS_grid_blocks', conn)
+    # Default to every attribute column of the grid
+    if columns is None:
+        with sqlite3.connect(database_path) as conn:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info("AMS_grid_blocks")')
+                       if row[1] != 'geometry' and not row[1].endswith(WKB_SUFFIX)]
 
-    # Convert geometry from text to object
-    ams_grid_data['geometry'] = ams_grid_data['geometry'].apply(wkt.loads)
+    geometry_columns = ['geometry'] if geometry else []
+    ams_grid_data = read_geometry_table(database_path, 'AMS_grid_blocks', columns, geometry_columns)
     
     return ams_grid_data
 
-@st.cache_data
+@traced
 def load_tree_damage_model(pickle_path):
     
-    # Tree damage model    
-    with open(pickle_path, 'rb') as handle:
-        tree_pipeline = pickle.load(handle)
-    
-    return tree_pipeline
+    # Tree damage model, loaded once per process by the model registry
+    return get_pipeline(pickle_path)
     
-@st.cache_data
+@traced
 def load_building_damage_model(pickle_path):
     
-    # Building damage model
-    with open(pickle_path, 'rb') as handle:
-        building_pipeline = pickle.load(handle)
+    # Building damage model, loaded once per process by the model registry
+    return get_pipeline(pickle_path)
 
-    return building_pipeline
+def total_probability(building_proba, tree_proba):
 
-@st.cache_data
+    # Probability of any damage in a cell, used by every prediction path
+    return building_proba + tree_proba ## NEEDS TO BE FIXED (events not independent)
+
+# Not behind st.cache_data, the pages keep the results in the shared prediction store
+@traced
 def predict_manual_damage(leaveson, past_rain, wind_speed_average, wind_speed_maximum, past_strong_wind, past_avg_wind, past_max_wind):
     
     # Copy grid data to prediction df
-    prediction_df = get_ams_base_grid_data("Code/data/model_data.sqlite")
+    prediction_df = get_ams_base_grid_data("Code/data/model_data.sqlite").copy()
+    prediction_df['cell_id'] = np.arange(len(prediction_df))
 
     # Add weather data to the prediction df
     weather_columns = [
@@ -255,7 +466,7 @@ def predict_manual_damage(leaveson, past_rain, wind_speed_average, wind_speed_ma
 
     # Define the column names that were used for the model fitting
     building_pipeline = load_building_damage_model('Code/Andras/xgb_building_pipeline.pickle')
-    tree_pipeline = load_building_damage_model('Code/Andras/xgb_tree_pipeline.pickle')
+    tree_pipeline = load_tree_damage_model('Code/Andras/xgb_tree_pipeline.pickle')
     
     building_columns = building_pipeline.feature_names_in_
     tree_columns = tree_pipeline.feature_names_in_
@@ -263,38 +474,100 @@ def predict_manual_damage(leaveson, past_rain, wind_speed_average, wind_speed_ma
     # Run model prediction
     prediction_df['building_proba'] = building_pipeline.predict_proba(prediction_df[building_columns])[:,1]
     prediction_df['tree_proba'] = tree_pipeline.predict_proba(prediction_df[tree_columns])[:,1]
-    prediction_df['total_proba'] = prediction_df['building_proba'] + prediction_df['tree_proba'] ## NEEDS TO BE FIXED (events not independent)
+    prediction_df['total_proba'] = total_probability(prediction_df['building_proba'], prediction_df['tree_proba'])
 
     # Convert to geopandas
     prediction_gdf = gpd.GeoDataFrame(prediction_df, crs='epsg:28992')
     
     return prediction_df
 
-@st.cache_data
-def predict_future_damage(forecast_df):
-    # Copy grid data to prediction df
-    grid_df = get_ams_base_grid_data("Code/data/model_data.sqlite")
+@traced
+def cross_join_index(n_cells, n_days, start=0, stop=None):
 
-    # Create a new DataFrame by combining the grid and weather forecasts
-    all_combinations = list(product(range(len(grid_df)), range(len(forecast_df))))
-    prediction_df = pd.DataFrame([grid_df.iloc[i[0]].tolist() + forecast_df.iloc[i[1]].tolist() for i in all_combinations],
-                             columns=list(grid_df.columns) + list(forecast_df.columns))
-    
-    # Define the column names that were used for the model fitting
-    building_pipeline = load_building_damage_model('Code/Andras/xgb_building_pipeline.pickle')
-    tree_pipeline = load_building_damage_model('Code/Andras/xgb_tree_pipeline.pickle')
-    
-    building_columns = building_pipeline.feature_names_in_
-    tree_columns = tree_pipeline.feature_names_in_
+    # Every grid cell is combined with every forecast day (cell-major order, so
+    # row r belongs to cell r // n_days and day r % n_days). start/stop select
+    # a slice of these rows without building the rows before or after it.
+    if stop is None:
+        stop = n_cells * n_days
+    rows = np.arange(start, stop)
 
-    # Run model prediction
-    prediction_df['building_proba'] = building_pipeline.predict_proba(prediction_df[building_columns])[:,1]
-    prediction_df['tree_proba'] = tree_pipeline.predict_proba(prediction_df[tree_columns])[:,1]
-    prediction_df['total_proba'] = prediction_df['building_proba'] + prediction_df['tree_proba'] ## NEEDS TO BE FIXED (events not independent)
+    return rows // n_days, rows % n_days
+
+@traced
+def cross_join_matrix(grid_df, forecast_df, columns, cell_index, day_index):
+
+    # Contiguous float32 feature matrix for the given (cell, day) pairs, gathered
+    # column by column straight from the grid and forecast arrays
+    X = np.empty((len(cell_index), len(columns)), dtype=np.float32)
+    for k, column in enumerate(columns):
+        if column in forecast_df.columns:
+            X[:, k] = forecast_df[column].to_numpy()[day_index]
+        else:
+            X[:, k] = grid_df[column].to_numpy()[cell_index]
+
+    return X
+
+def iter_future_damage(forecast_df, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+
+    # Compiled scorers with the column names that were used for the model fitting
+    building_scorer = get_scorer('Code/Andras/xgb_building_pipeline.pickle')
+    tree_scorer = get_scorer('Code/Andras/xgb_tree_pipeline.pickle')
+
+    building_columns = building_scorer.feature_names
+    tree_columns = tree_scorer.feature_names
+    model_columns = set(building_columns) | set(tree_columns)
+
+    # Only carry the model inputs through the chunks, geometry is not loaded at all
+    grid_columns = tuple(sorted(c for c in model_columns if c not in forecast_df.columns))
+    grid_features = get_ams_base_grid_data("Code/data/model_data.sqlite", grid_columns, geometry=False)
+    dates = forecast_df['date'].to_numpy()
+
+    # Rough size of one row while it is being scored: the float32 feature matrices,
+    # their float64 scaled copies and the float32 block handed to the booster
+    row_bytes = (4 + 8 + 4) * (len(building_columns) + len(tree_columns)) + 3 * 4
+    chunk_rows = max(1, int(memory_budget_mb * 1024**2 // row_bytes))
+
+    n_days = len(forecast_df)
+    n_rows = len(grid_features) * n_days
+
+    for start in range(0, n_rows, chunk_rows):
+        stop = min(start + chunk_rows, n_rows)
+        cell_index, day_index = cross_join_index(len(grid_features), n_days, start, stop)
+
+        building_X = cross_join_matrix(grid_features, forecast_df, building_columns, cell_index, day_index)
+        tree_X = cross_join_matrix(grid_features, forecast_df, tree_columns, cell_index, day_index)
+
+        # Run model prediction
+        with span('xgboost_score'):
+            building_proba = building_scorer.score(building_X)
+            tree_proba = tree_scorer.score(tree_X)
+
+        yield pd.DataFrame({'cell_id': cell_index,
+                            'date': dates[day_index],
+                            'building_proba': building_proba,
+                            'tree_proba': tree_proba,
+                            'total_proba': total_probability(building_proba, tree_proba)})
+
+@traced
+def predict_future_damage(forecast_df, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+
+    # Score the (cells x days) cube chunk by chunk, only the probabilities are kept
+    prediction_df = pd.concat(iter_future_damage(forecast_df, memory_budget_mb), ignore_index=True)
+
+    return prediction_df
+
+@traced
+def attach_grid_geometry(prediction_df):
+
+    # Re-attach the grid attributes and geometry to a (small) slice of predictions
+    grid_df = get_ams_base_grid_data("Code/data/model_data.sqlite")
+    grid_slice = grid_df.take(prediction_df['cell_id'].to_numpy())
+
+    prediction_gdf = pd.concat([grid_slice.reset_index(drop=True),
+                                prediction_df.reset_index(drop=True)], axis=1)
 
     # Convert to geopandas
-    prediction_gdf = gpd.GeoDataFrame(prediction_df, crs='epsg:28992')
+    prediction_gdf = gpd.GeoDataFrame(prediction_gdf, crs='epsg:28992')
 
     return prediction_gdf
 
-
@@ -0,0 +1,79 @@
+import os
+import json
+import base64
+import numpy as np
+import streamlit as st
+import streamlit.components.v1 as components
+from functions import get_firestation_data
+from map_layers import MAP_ZOOM
+from grid_pyramid import get_grid_pyramid, get_pyramid_layer, level_for_zoom, zoom_range
+from service_areas import grid_fingerprint
+from instrumentation import cached, traced
+
+# Map component that keeps the grid geometry in the browser (grid_map/index.html)
+_grid_map = components.declare_component('grid_map', path=os.path.join(os.path.dirname(__file__), 'grid_map'))
+
+MAP_COLUMNS = ['building_proba', 'tree_proba', 'total_proba']
+
+
+@cached
+def overlay_layer(database_path):
+
+    # Service area boundaries and stations in lat/lon, sent to the browser with the grid
+    firestations, service_areas = get_firestation_data(database_path)
+    features = json.loads(service_areas.to_crs('epsg:4326').to_json())['features'] + \
+               json.loads(firestations.to_crs('epsg:4326').to_json())['features']
+
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def quantize(values):
+
+    # One byte per cell, scaled to the largest value of the selection
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+    scale = max(float(values.max(initial=0)), 1e-6)
+    levels = np.round(values / scale * 255).astype(np.uint8)
+
+    return base64.b64encode(levels.tobytes()).decode('ascii'), scale
+
+
+@traced
+def grid_map(level_frame, column, label, show_overlay=False, key='grid_map', zoom=MAP_ZOOM,
+             center=(52.360, 4.886), height=600, database_path="Code/data/model_data.sqlite"):
+
+    # level_frame(level) returns the selection at a pyramid level (one row per cell of that
+    # level, in id order), or None when there is nothing to show. The browser reports its
+    # zoom and the level that matches it is sent (see grid_pyramid.py).
+    value = st.session_state.get(key) or {}
+    version = grid_fingerprint(database_path)
+    pyramid = get_grid_pyramid(database_path, version)
+    level = level_for_zoom(pyramid, value.get('zoom', zoom))
+    layer = get_pyramid_layer(database_path, level, version)
+
+    # Each level's geometry goes out once per session, or again when the browser asks for
+    # it (a reloaded frame has lost everything it was sent)
+    sent_key = f'{key}_geometry'
+    sent = st.session_state.get(sent_key)
+    if sent is None or sent['request'] != value.get('request'):
+        sent = st.session_state[sent_key] = {'request': value.get('request'), 'versions': set()}
+    send_geometry = layer['version'] not in sent['versions']
+    sent['versions'].add(layer['version'])
+
+    args = {'version': layer['version'], 'center': list(center), 'zoom': zoom, 'height': height,
+            'zoom_range': zoom_range(pyramid, level), 'column': column, 'label': label,
+            'show_overlay': show_overlay, 'columns': MAP_COLUMNS,
+            'geometry': None, 'overlay': None, 'values': None, 'scales': None}
+
+    if send_geometry:
+        args['geometry'] = {'type': 'FeatureCollection', 'features': layer['features']}
+        if not sent.get('overlay'):
+            args['overlay'] = overlay_layer(database_path)
+            sent['overlay'] = True
+
+    prediction_df = level_frame(level)
+    if prediction_df is not None:
+        encoded = [quantize(prediction_df[name].to_numpy()) for name in MAP_COLUMNS]
+        args['values'] = [values for values, _ in encoded]
+        args['scales'] = [scale for _, scale in encoded]
+
+    return _grid_map(key=key, default=None, **args)
@@ -0,0 +1,174 @@
+import os
+import numpy as np
+import pandas as pd
+import shapely
+import streamlit as st
+from functions import get_ams_base_grid_data
+from map_layers import LAYER_DIR, CACHED_GRID_VERSIONS, get_grid_layer, geojson_layer
+from service_areas import grid_fingerprint
+from prediction_index import PredictionIndex, PROBA_COLUMNS
+from instrumentation import traced
+
+# Parent cell assignment per grid version
+PYRAMID_DIR = "Code/data/grid_pyramid"
+
+# Every level doubles the cell size of the level below it, level 0 is the grid itself
+PYRAMID_LEVELS = 6
+
+# Drawn cells should be at least this many pixels wide, smaller ones are merged into parents
+MIN_CELL_PIXELS = 4
+
+# Web mercator metres per pixel at zoom 0 on the equator, and the latitude of Amsterdam
+EQUATOR_METRES_PER_PIXEL = 156543.03
+MAP_LATITUDE = 52.360
+
+ROLLUP_STATISTICS = ['max', 'mean']
+
+
+@traced
+def build_grid_pyramid(geometry):
+
+    # Square parent cells aligned to the grid origin, sized from the typical grid cell
+    x, y = shapely.get_coordinates(shapely.centroid(geometry)).T
+    x0, y0 = geometry_origin(geometry)
+    cell_size = float(np.median(np.sqrt(shapely.area(geometry))))
+
+    pyramid = {'cell_size': np.array([cell_size * 2 ** level for level in range(PYRAMID_LEVELS)]),
+               'origin': np.array([x0, y0]), 'n_cells': np.int64(len(geometry))}
+
+    for level in range(1, PYRAMID_LEVELS):
+        size = pyramid['cell_size'][level]
+        column = np.floor((x - x0) / size).astype(np.int64)
+        row = np.floor((y - y0) / size).astype(np.int64)
+
+        # Parents are numbered in (column, row) order, only parents with cells exist
+        n_rows = row.max() + 1
+        keys, parent = np.unique(column * n_rows + row, return_inverse=True)
+        pyramid[f'parent_{level}'] = parent.astype(np.int32)
+        pyramid[f'tile_{level}'] = np.stack([keys // n_rows, keys % n_rows], axis=1)
+
+    return pyramid
+
+
+def geometry_origin(geometry):
+
+    bounds = shapely.bounds(geometry)
+
+    return bounds[:, 0].min(), bounds[:, 1].min()
+
+
+def pyramid_path(version):
+
+    return os.path.join(PYRAMID_DIR, f'grid_{version}.npz')
+
+
+@st.cache_resource(max_entries=CACHED_GRID_VERSIONS)
+def get_grid_pyramid(database_path, version):
+
+    # Built once per grid version (service_areas.grid_fingerprint), shared by all sessions
+    # of the process
+    path = pyramid_path(version)
+
+    if os.path.exists(path):
+        with np.load(path, allow_pickle=False) as stored:
+            pyramid = {key: stored[key] for key in stored.files}
+    else:
+        geometry = get_ams_base_grid_data(database_path, columns=(), geometry=True)['geometry'].to_numpy()
+        pyramid = build_grid_pyramid(geometry)
+        os.makedirs(PYRAMID_DIR, exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(temporary_path, **pyramid)
+        os.replace(temporary_path, path)
+
+    pyramid['version'] = version
+
+    # Cells sorted by parent, so a roll-up is one reduceat over contiguous runs
+    for level in range(1, PYRAMID_LEVELS):
+        order = np.argsort(pyramid[f'parent_{level}'], kind='stable')
+        pyramid[f'order_{level}'] = order
+        pyramid[f'starts_{level}'] = np.flatnonzero(np.diff(pyramid[f'parent_{level}'][order], prepend=-1))
+
+    return pyramid
+
+
+def level_for_zoom(pyramid, zoom):
+
+    # Finest level whose cells are at least MIN_CELL_PIXELS wide at this zoom
+    metres_per_pixel = EQUATOR_METRES_PER_PIXEL * np.cos(np.radians(MAP_LATITUDE)) / 2 ** zoom
+    wide_enough = np.flatnonzero(pyramid['cell_size'] >= MIN_CELL_PIXELS * metres_per_pixel)
+
+    return int(wide_enough[0]) if len(wide_enough) else PYRAMID_LEVELS - 1
+
+
+def zoom_range(pyramid, level, zooms=range(0, 21)):
+
+    # Zoom levels the map can move between without changing the pyramid level
+    matching = [zoom for zoom in zooms if level_for_zoom(pyramid, zoom) == level]
+
+    return [min(matching), max(matching)] if matching else [0, 20]
+
+
+@traced
+def build_pyramid_layer(database_path, level, version):
+
+    pyramid = get_grid_pyramid(database_path, version)
+
+    # Parent squares in the projected crs, written like the grid layers
+    def parent_squares():
+        size = pyramid['cell_size'][level]
+        x0, y0 = pyramid['origin']
+        column, row = pyramid[f'tile_{level}'].T
+        return shapely.box(x0 + column * size, y0 + row * size, x0 + (column + 1) * size, y0 + (row + 1) * size)
+
+    return geojson_layer(os.path.join(LAYER_DIR, f'grid_{version}_L{level}.geojson'), parent_squares)
+
+
+@st.cache_resource(max_entries=CACHED_GRID_VERSIONS * PYRAMID_LEVELS)
+def get_pyramid_layer(database_path, level, version):
+
+    # Level 0 is the simplified grid itself. Shared, callers must not modify it
+    if level == 0:
+        return get_grid_layer(database_path, version)
+
+    return build_pyramid_layer(database_path, level, version)
+
+
+def rollup(pyramid, level, values):
+
+    # (periods x cells) -> (periods x parents) maximum and mean over the cells of each parent
+    order, starts = pyramid[f'order_{level}'], pyramid[f'starts_{level}']
+    counts = np.diff(np.append(starts, len(order)))
+    ordered = np.asarray(values)[:, order]
+
+    return {'max': np.maximum.reduceat(ordered, starts, axis=1),
+            'mean': (np.add.reduceat(ordered, starts, axis=1, dtype=np.float64) / counts).astype(np.float32)}
+
+
+def rollup_period(index, period, level, statistic, database_path="Code/data/model_data.sqlite"):
+
+    # One period of an index rolled up to a level, for indexes without precomputed roll-ups
+    pyramid = get_grid_pyramid(database_path, grid_fingerprint(database_path))
+    row = index.positions[pd.Timestamp(period)]
+    arrays = {column: rollup(pyramid, level, index.rows(row, row + 1, column))[statistic]
+              for column in PROBA_COLUMNS + ['total_proba']}
+
+    return PredictionIndex([period], arrays).frame(period)
+
+
+@traced
+def pyramid_rollups(index, database_path="Code/data/model_data.sqlite"):
+
+    # Roll-ups of every hour of a prediction run, one PredictionIndex per (level, statistic).
+    # total_proba is rolled up from the per-cell totals, the maximum of a sum is not the sum of maxima.
+    pyramid = get_grid_pyramid(database_path, grid_fingerprint(database_path))
+    columns = PROBA_COLUMNS + ['total_proba']
+    values = {column: index.rows(0, len(index.periods), column) for column in columns}
+
+    rollups = {}
+    for level in range(1, PYRAMID_LEVELS):
+        rolled = {column: rollup(pyramid, level, values[column]) for column in columns}
+        for statistic in ROLLUP_STATISTICS:
+            rollups[(level, statistic)] = PredictionIndex(
+                index.periods, {column: rolled[column][statistic] for column in columns})
+
+    return rollups
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+# Hourly rolling predictors: name -> (source variable, aggregation, window in hours)
+ROLLING_FEATURES = {
+    'Precipitation past week': ('precipitation', 'sum', 7 * 24),
+    'Precipitation past two week': ('precipitation', 'sum', 14 * 24),
+    'Average wind past two days': ('wind_speed_10m', 'mean', 48),
+    'Average wind past three days': ('wind_speed_10m', 'mean', 72),
+    'Strong wind past two days': ('wind_speed_10m', 'exceedance', 48),
+    'Max wind past day': ('wind_gusts_10m', 'max', 24),
+}
+
+# Wind speed (m/s) above which an hour counts as strong wind
+STRONG_WIND_THRESHOLD = 15
+
+SOURCE_COLUMNS = ['precipitation', 'wind_speed_10m', 'wind_gusts_10m']
+
+
+def window_sums(values, window):
+
+    # Trailing window sums from one cumulative sum; windows that contain a
+    # missing value, or reach before the first hour, are NaN (like rolling(window))
+    missing = np.isnan(values)
+    totals = np.concatenate([[0], np.cumsum(np.where(missing, 0, values), dtype=np.float64)])
+    gaps = np.concatenate([[0], np.cumsum(missing)])
+
+    sums = np.full(len(values), np.nan)
+    if len(values) >= window:
+        sums[window - 1:] = totals[window:] - totals[:-window]
+        has_gap = (gaps[window:] - gaps[:-window]) > 0
+        sums[window - 1:][has_gap] = np.nan
+
+    return sums
+
+
+def window_maxima(values, window):
+
+    # Trailing window maxima without a Python loop (van Herk/Gil-Werman, the
+    # block-wise equivalent of a monotonic deque): split the series into blocks
+    # of the window length, take running maxima forwards and backwards inside
+    # each block, and every window is covered by one suffix and one prefix
+    n = len(values)
+    maxima = np.full(n, np.nan)
+    if n < window:
+        return maxima
+
+    n_blocks = -(-n // window)
+    padded = np.full(n_blocks * window, -np.inf)
+    padded[:n] = np.where(np.isnan(values), np.inf, values)
+    blocks = padded.reshape(n_blocks, window)
+
+    prefix = np.maximum.accumulate(blocks, axis=1).ravel()
+    suffix = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+    # Window ending at hour i starts at i - window + 1
+    ends = np.arange(window - 1, n)
+    maxima[window - 1:] = np.maximum(suffix[ends - window + 1], prefix[ends])
+
+    # Missing values were set to +inf so they can be recognised here
+    maxima[np.isinf(maxima)] = np.nan
+
+    return maxima
+
+
+def rolling_feature(values, how, window):
+
+    if how == 'sum':
+        return window_sums(values, window)
+    if how == 'mean':
+        return window_sums(values, window) / window
+    if how == 'exceedance':
+        exceeds = np.where(np.isnan(values), np.nan, values > STRONG_WIND_THRESHOLD)
+        return window_sums(exceeds, window)
+    if how == 'max':
+        return window_maxima(values, window)
+
+    raise ValueError(f'Unknown rolling aggregation: {how}')
+
+
+def hourly_series(hist_result, forecast_result):
+
+    # History first, the forecast only for the hours after the last measured hour
+    hist_result = hist_result.dropna()
+    forecast_result = forecast_result[forecast_result['timestamp'] > hist_result['timestamp'].max()] \
+        if len(hist_result) else forecast_result
+    series = pd.concat([hist_result[['timestamp'] + SOURCE_COLUMNS],
+                        forecast_result[['timestamp'] + SOURCE_COLUMNS]], ignore_index=True)
+
+    # Regular hourly axis, so window lengths in rows are window lengths in hours
+    hours = pd.date_range(series['timestamp'].min(), series['timestamp'].max(), freq='h')
+
+    return series.set_index('timestamp').reindex(hours).rename_axis('timestamp').reset_index()
+
+
+def hourly_predictors(hist_result, forecast_result, start=None):
+
+    series = hourly_series(hist_result, forecast_result)
+    values = {column: series[column].to_numpy(dtype=np.float64) for column in SOURCE_COLUMNS}
+
+    predictors = pd.DataFrame({'timestamp': series['timestamp'],
+                               'date': series['timestamp'].dt.date,
+                               'Hour': series['timestamp'].dt.hour,
+                               'Leaves on or not': series['timestamp'].dt.month.isin([4,5,6,7,8,9]).astype(int),
+                               'Average hourly wind speed (m/s)': values['wind_speed_10m'],
+                               'Maximum hourly wind speed (m/s)': values['wind_gusts_10m']})
+
+    for name, (column, how, window) in ROLLING_FEATURES.items():
+        predictors[name] = rolling_feature(values[column], how, window)
+
+    # Optionally drop the warm-up hours before the first hour of interest
+    if start is not None:
+        predictors = predictors[predictors['timestamp'] >= pd.Timestamp(start)].reset_index(drop=True)
+
+    return predictors
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import logging
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+import streamlit as st
+
+# Unix only, peak memory is not reported without it (e.g. on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Finished spans kept in memory for the sidebar panel and trace export
+TRACE_CAPACITY = 5000
+
+# Optional JSON-lines log of every span, e.g. INSTRUMENT_LOG=Code/data/trace.jsonl
+TRACE_LOG_PATH = os.environ.get('INSTRUMENT_LOG')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+logger = logging.getLogger('instrumentation')
+if TRACE_LOG_PATH:
+    _handler = logging.FileHandler(TRACE_LOG_PATH)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+_events = deque(maxlen=TRACE_CAPACITY)
+_sequence = 0
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def current_rss():
+
+    # Resident memory in bytes (Linux), 0 where /proc is not available
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return 0
+
+
+def peak_rss():
+
+    # Peak resident memory of the process in bytes (ru_maxrss is in kB on Linux), 0 where
+    # the resource module is not available
+    if resource is None:
+        return 0
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def active_spans():
+
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+
+    return _local.stack
+
+
+@contextmanager
+def span(name, cached=False):
+
+    # Wall time, resident memory change and growth of the peak memory of one block.
+    # Spans nest per thread, so a trace shows which function called which.
+    global _sequence
+    stack = active_spans()
+    event = {'name': name, 'thread': threading.get_ident(), 'depth': len(stack),
+             'parent': stack[-1]['name'] if stack else None, 'cache': 'hit' if cached else None}
+    stack.append(event)
+
+    rss_before, peak_before = current_rss(), peak_rss()
+    event['start'] = time.time()
+    start = time.perf_counter()
+    try:
+        yield event
+    except Exception as error:
+        event['error'] = f'{type(error).__name__}: {error}'
+        raise
+    finally:
+        event['seconds'] = time.perf_counter() - start
+        event['rss_delta_mb'] = (current_rss() - rss_before) / 1024**2
+        event['peak_delta_mb'] = (peak_rss() - peak_before) / 1024**2
+        stack.pop()
+
+        with _lock:
+            _sequence += 1
+            event['sequence'] = _sequence
+            _events.append(event)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(event, default=str))
+
+
+def traced(func=None, name=None, cached=False):
+
+    # @traced on a function records a span for every call
+    if func is None:
+        return functools.partial(traced, name=name, cached=cached)
+
+    span_name = name or func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(span_name, cached):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def cache_body(func, name):
+
+    # Runs inside st.cache_data, so it only executes on a cache miss. Marks the enclosing
+    # span as a miss; the rest of that span's time is spent hashing and copying.
+    @functools.wraps(func)
+    def body(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack = active_spans()
+            if stack and stack[-1]['name'] == name:
+                stack[-1]['cache'] = 'miss'
+                stack[-1]['body_seconds'] = time.perf_counter() - start
+
+    return body
+
+
+def cached(func=None, **cache_options):
+
+    # Drop-in for @st.cache_data that also records the span and whether it was a cache hit
+    if func is None:
+        return functools.partial(cached, **cache_options)
+
+    name = func.__qualname__
+    cached_func = st.cache_data(**cache_options)(cache_body(func, name))
+    wrapper = traced(cached_func, name=name, cached=True)
+    wrapper.clear = cached_func.clear
+
+    return wrapper
+
+
+def trace_position():
+
+    # Sequence number of the last finished span; pages read the spans of one rerun after it
+    with _lock:
+        return _sequence
+
+
+def events_since(position=0, thread=None):
+
+    with _lock:
+        events = [event for event in _events if event['sequence'] > position]
+    if thread is not None:
+        events = [event for event in events if event['thread'] == thread]
+
+    return events
+
+
+def chrome_trace(events):
+
+    # Trace Event Format, opens in chrome://tracing or Perfetto
+    return json.dumps({'traceEvents': [
+        {'name': event['name'], 'ph': 'X', 'pid': os.getpid(), 'tid': event['thread'],
+         'ts': event['start'] * 1e6, 'dur': event['seconds'] * 1e6,
+         'args': {key: event.get(key) for key in ['cache', 'body_seconds', 'rss_delta_mb', 'peak_delta_mb', 'error']
+                  if event.get(key) is not None}}
+        for event in events]}, default=str)
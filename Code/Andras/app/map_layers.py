@@ -0,0 +1,94 @@
+import os
+import json
+import threading
+import shapely
+import folium
+import geopandas as gpd
+import branca.colormap as cm
+import streamlit as st
+from functions import get_ams_base_grid_data
+from service_areas import grid_fingerprint
+from instrumentation import traced
+
+# Compact GeoJSON versions of the grid are written here, one file per grid version
+LAYER_DIR = "Code/data/map_layers"
+
+# ~1 m precision is plenty for the map and keeps the GeoJSON compact. The grid cells are
+# squares, so this is all the reduction there is: simplifying them removes no vertices.
+COORDINATE_PRECISION = 1e-5
+
+# Zoom level the dashboard pages open their maps at
+MAP_ZOOM = 12
+
+# Grid versions whose layers stay in memory, the previous one while sessions move over
+CACHED_GRID_VERSIONS = 2
+
+
+def geojson_layer(layer_path, projected_geometry):
+
+    # Written once per path: the cells in lat/lon at COORDINATE_PRECISION, feature id = position.
+    # projected_geometry returns the epsg:28992 geometry and is only called to write the file.
+    if not os.path.exists(layer_path):
+        geometry = gpd.GeoSeries(projected_geometry(), crs='epsg:28992').to_crs('epsg:4326').to_numpy()
+        geometry = shapely.set_precision(geometry, COORDINATE_PRECISION)
+
+        # Only the id is stored, the prediction values are joined on per run
+        features = ','.join(f'{{"type":"Feature","id":{feature_id},"properties":{{}},"geometry":{geom}}}'
+                            for feature_id, geom in enumerate(shapely.to_geojson(geometry)))
+
+        os.makedirs(LAYER_DIR, exist_ok=True)
+        temporary_path = f'{layer_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'w') as handle:
+            handle.write(f'{{"type":"FeatureCollection","features":[{features}]}}')
+        os.replace(temporary_path, layer_path)
+
+    with open(layer_path) as handle:
+        layer = json.load(handle)
+
+    # Lets clients that keep the geometry (see grid_map.py) tell grid versions apart
+    layer['version'] = os.path.basename(layer_path)
+
+    return layer
+
+
+@traced
+def build_grid_layer(database_path, version):
+
+    # Built once per grid version
+    return geojson_layer(os.path.join(LAYER_DIR, f'grid_{version}.geojson'),
+                         lambda: get_ams_base_grid_data(database_path, columns=(), geometry=True)['geometry'].to_numpy())
+
+
+@st.cache_resource(max_entries=CACHED_GRID_VERSIONS)
+def get_grid_layer(database_path, version):
+
+    # Shared by all sessions of the process, callers must not modify it. version is the
+    # grid fingerprint (service_areas.grid_fingerprint), so an edited grid gets a new layer.
+    return build_grid_layer(database_path, version)
+
+
+@traced
+def add_prediction_layer(m, prediction_df, column, layer_name, database_path="Code/data/model_data.sqlite"):
+
+    features = get_grid_layer(database_path, grid_fingerprint(database_path))['features']
+
+    # Join the probabilities of this run onto the cached geometry. folium still sends the
+    # geometry with every render, only grid_map.py keeps it in the browser.
+    cell_ids = prediction_df['cell_id'].to_numpy()
+    values = prediction_df[column].to_numpy().astype(float).round(4)
+    layer = {'type': 'FeatureCollection',
+             'features': [{**features[cell_id], 'properties': {column: value}}
+                          for cell_id, value in zip(cell_ids.tolist(), values.tolist())]}
+
+    colormap = cm.LinearColormap(colors=['white', 'red'], vmin=0, vmax=max(values.max(initial=0), 1e-6),
+                                 caption=layer_name)
+
+    folium.GeoJson(data=layer,
+                   name=layer_name,
+                   style_function=lambda feature: {'fillColor': colormap(feature['properties'][column]),
+                                                   'color': 'black', 'weight': 0.1, 'opacity': 0.4,
+                                                   'fillOpacity': 0.8},
+                   popup=folium.GeoJsonPopup(fields=[column])).add_to(m)
+    m.add_child(colormap)
+
+    return m
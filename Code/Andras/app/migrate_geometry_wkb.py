@@ -0,0 +1,49 @@
+import sys
+import sqlite3
+import pandas as pd
+import shapely
+
+# One-time migration: store a WKB copy of the WKT geometry columns so the
+# loaders in functions.py can decode them with shapely's vectorized from_wkb.
+# The WKT columns are left in place for scripts that still read them.
+#
+# Usage (from the repository root):
+#     python Code/Andras/app/migrate_geometry_wkb.py [Code/data/model_data.sqlite]
+
+WKB_SUFFIX = '_wkb'
+
+GEOMETRY_COLUMNS = {
+    'AMS_grid_blocks': ['geometry'],
+    'Firestations': ['Firestation location', 'Service area geometry'],
+}
+
+
+def migrate_table(conn, table, geometry_columns):
+
+    available = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+
+    for column in geometry_columns:
+        wkb_column = column + WKB_SUFFIX
+        if wkb_column not in available:
+            conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{wkb_column}" BLOB')
+
+        # Parse all WKT values at once and write them back as WKB
+        table_data = pd.read_sql(f'SELECT rowid, "{column}" FROM "{table}"', conn)
+        geometries = shapely.from_wkt(table_data[column].to_numpy())
+        wkb_values = shapely.to_wkb(geometries)
+
+        conn.executemany(f'UPDATE "{table}" SET "{wkb_column}" = ? WHERE rowid = ?',
+                         zip(wkb_values.tolist(), table_data['rowid'].tolist()))
+
+        print(f'{table}.{column}: {len(table_data)} geometries written to {wkb_column}')
+
+
+def migrate(database_path):
+
+    with sqlite3.connect(database_path) as conn:
+        for table, geometry_columns in GEOMETRY_COLUMNS.items():
+            migrate_table(conn, table, geometry_columns)
+
+
+if __name__ == '__main__':
+    migrate(sys.argv[1] if len(sys.argv) > 1 else 'Code/data/model_data.sqlite')
@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+import threading
+import tracemalloc
+import numpy as np
+import xgboost as xgb
+
+# Known-good content hashes of the pickled pipelines (path -> sha256)
+MANIFEST_PATH = 'Code/Andras/model_hashes.json'
+
+# Suffixes of the native export written next to each pickle
+BOOSTER_SUFFIX = '.ubj'
+SCALER_SUFFIX = '.scaler.json'
+
+_models = {}
+_load_stats = {}
+_lock = threading.Lock()
+
+
+class NativePipeline:
+
+    # Drop-in replacement for the scaler + XGBClassifier pipeline, loaded from the native export
+
+    def __init__(self, booster, feature_names, mean, scale):
+        self.booster = booster
+        self.feature_names_in_ = np.array(feature_names, dtype=object)
+        self.mean_ = np.asarray(mean, dtype=np.float64)
+        self.scale_ = np.asarray(scale, dtype=np.float64)
+
+    def predict_proba(self, X):
+        X = (np.asarray(X, dtype=np.float64) - self.mean_) / self.scale_
+        proba = self.booster.inplace_predict(X.astype(np.float32))
+
+        return np.column_stack([1 - proba, proba])
+
+
+def file_hash(path):
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def read_manifest(manifest_path=MANIFEST_PATH):
+
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as handle:
+        return json.load(handle)
+
+
+def verify_pickle(pickle_path, manifest_path=MANIFEST_PATH):
+
+    # Refuse to load a pickle whose content differs from the recorded hash
+    content_hash = file_hash(pickle_path)
+    expected = read_manifest(manifest_path).get(pickle_path)
+    if expected is not None and expected != content_hash:
+        raise ValueError(f'{pickle_path} does not match its hash in {manifest_path}, '
+                         f'expected {expected[:12]} but found {content_hash[:12]}')
+
+    return content_hash
+
+
+def export_native(pickle_path):
+
+    # Write the booster as UBJ and the scaler parameters as JSON next to the pickle
+    content_hash = file_hash(pickle_path)
+    with open(pickle_path, 'rb') as handle:
+        pipeline = pickle.load(handle)
+    scaler, classifier = pipeline.steps[0][1], pipeline.steps[-1][1]
+
+    classifier.get_booster().save_model(pickle_path + BOOSTER_SUFFIX)
+    with open(pickle_path + SCALER_SUFFIX, 'w') as handle:
+        json.dump({'source_hash': content_hash,
+                   'feature_names': [str(name) for name in pipeline.feature_names_in_],
+                   'mean': scaler.mean_.tolist(),
+                   'scale': scaler.scale_.tolist()}, handle)
+
+    return content_hash
+
+
+def load_native(pickle_path, content_hash):
+
+    # Only use the native export when it was made from this exact pickle
+    scaler_path = pickle_path + SCALER_SUFFIX
+    if not os.path.exists(scaler_path) or not os.path.exists(pickle_path + BOOSTER_SUFFIX):
+        return None
+    with open(scaler_path) as handle:
+        scaler = json.load(handle)
+    if scaler['source_hash'] != content_hash:
+        return None
+
+    booster = xgb.Booster(model_file=pickle_path + BOOSTER_SUFFIX)
+
+    return NativePipeline(booster, scaler['feature_names'], scaler['mean'], scaler['scale'])
+
+
+def get_pipeline(pickle_path):
+
+    # Loaded once per process and shared read-only by every session
+    if pickle_path in _models:
+        return _models[pickle_path]
+
+    with _lock:
+        if pickle_path not in _models:
+            content_hash = verify_pickle(pickle_path)
+
+            # Python memory of the load is only measured when nobody else is tracing, their
+            # trace is not restarted or stopped under them
+            measure = not tracemalloc.is_tracing()
+            start = time.perf_counter()
+            if measure:
+                tracemalloc.start()
+            pipeline = load_native(pickle_path, content_hash)
+            source = 'native'
+            if pipeline is None:
+                with open(pickle_path, 'rb') as handle:
+                    pipeline = pickle.load(handle)
+                source = 'pickle'
+
+            python_bytes = None
+            if measure:
+                python_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            # The booster lives in native memory that tracemalloc does not see
+            booster = pipeline.booster if source == 'native' else pipeline.steps[-1][1].get_booster()
+
+            _load_stats[pickle_path] = {'source': source,
+                                        'content_hash': content_hash,
+                                        'feature_names': [str(name) for name in pipeline.feature_names_in_],
+                                        'load_seconds': time.perf_counter() - start,
+                                        'python_bytes': python_bytes,
+                                        'booster_bytes': len(booster.save_raw())}
+            _models[pickle_path] = pipeline
+
+    return _models[pickle_path]
+
+
+def model_hash(pickle_path):
+
+    get_pipeline(pickle_path)
+
+    return _load_stats[pickle_path]['content_hash']
+
+
+def model_features(pickle_path):
+
+    # Input columns the pipeline was fitted on, from the metadata recorded when it was loaded
+    get_pipeline(pickle_path)
+
+    return list(_load_stats[pickle_path]['feature_names'])
+
+
+def load_report():
+
+    # Load time and memory per model loaded so far
+    return {path: {key: value for key, value in stats.items() if key != 'feature_names'}
+            for path, stats in _load_stats.items()}
+
+
+if __name__ == '__main__':
+    # Export the given pickles to the native format and record their hashes:
+    #     python Code/Andras/app/model_registry.py Code/Andras/xgb_building_pipeline.pickle ...
+    manifest = read_manifest()
+    for path in sys.argv[1:]:
+        manifest[path] = export_native(path)
+        print(f'{path}: exported {path + BOOSTER_SUFFIX}, sha256 {manifest[path][:12]}')
+    with open(MANIFEST_PATH, 'w') as handle:
+        json.dump(manifest, handle, indent=4)
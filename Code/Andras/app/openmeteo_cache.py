@@ -0,0 +1,121 @@
+import os
+import threading
+import datetime as dt
+import openmeteo_requests
+import requests_cache
+from requests_cache import NEVER_EXPIRE
+from retry_requests import retry
+from instrumentation import traced
+
+# Open-Meteo's forecast models start a new run every few hours (00, 06, 12 and 18 UTC)
+FORECAST_RUN_INTERVAL_HOURS = 6
+
+# A run is served by the API this long after it started
+FORECAST_PUBLICATION_DELAY = dt.timedelta(hours=4)
+
+# The archive (reanalysis) lags a few days behind; older days no longer change
+REANALYSIS_LAG_DAYS = 5
+
+# Recent archive days are still being filled in, so they are refreshed this often
+RECENT_ARCHIVE_EXPIRY = dt.timedelta(hours=1)
+
+# The cache file is trimmed back to this size
+CACHE_MAX_BYTES = 200 * 1024**2
+
+cache_stats = {'hits': 0, 'misses': 0, 'bytes_from_cache': 0, 'bytes_downloaded': 0}
+_stats_lock = threading.Lock()
+
+
+def count_response(response, *args, **kwargs):
+
+    # Response hook, also called for responses served from the cache. Downloaded
+    # responses pass through the hooks twice (requests and requests_cache), so count once.
+    if getattr(response, 'counted', False):
+        return response
+    response.counted = True
+
+    from_cache = getattr(response, 'from_cache', False)
+    with _stats_lock:
+        cache_stats['hits' if from_cache else 'misses'] += 1
+        cache_stats['bytes_from_cache' if from_cache else 'bytes_downloaded'] += len(response.content)
+
+    return response
+
+
+# One shared Open-Meteo client with a pooled, cached session and retry on error.
+# Nothing expires by default, every request passes its own expiry (see below).
+cache_session = requests_cache.CachedSession('.cache', expire_after = NEVER_EXPIRE)
+cache_session.hooks['response'].append(count_response)
+retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
+openmeteo = openmeteo_requests.Client(session = retry_session)
+
+
+def utc_time(now=None):
+
+    # Naive UTC, like the stored issue times. A naive now is taken to be local time.
+    now = dt.datetime.now(dt.timezone.utc) if now is None else now.astimezone(dt.timezone.utc)
+
+    return now.replace(tzinfo=None)
+
+
+def published_run(now=None):
+
+    # Start (UTC) of the newest model run the API is already serving
+    available = utc_time(now) - FORECAST_PUBLICATION_DELAY
+
+    return available.replace(hour=available.hour - available.hour % FORECAST_RUN_INTERVAL_HOURS,
+                             minute=0, second=0, microsecond=0)
+
+
+def forecast_expiry(now=None):
+
+    # A forecast response is valid until the next model run is published
+    next_publication = published_run(now) + dt.timedelta(hours=FORECAST_RUN_INTERVAL_HOURS) + FORECAST_PUBLICATION_DELAY
+
+    return next_publication.replace(tzinfo=dt.timezone.utc)
+
+
+def archive_expiry(end_date, today=None):
+
+    # Archive responses that end before the reanalysis lag never change again
+    if today is None:
+        today = dt.date.today()
+    if dt.date.fromisoformat(str(end_date)) < today - dt.timedelta(days=REANALYSIS_LAG_DAYS):
+        return NEVER_EXPIRE
+
+    return RECENT_ARCHIVE_EXPIRY
+
+
+def cache_size():
+
+    return os.path.getsize(cache_session.cache.db_path) if os.path.exists(cache_session.cache.db_path) else 0
+
+
+def evict_cache(max_bytes=CACHE_MAX_BYTES):
+
+    if cache_size() <= max_bytes:
+        return
+
+    # Expired responses go first, then the least recently written ones until the content
+    # fits again. Only keys and sizes are read, the responses are not loaded.
+    cache_session.cache.delete(expired=True)
+
+    responses = cache_session.cache.responses
+    with responses.connection() as conn:
+        stale = [row[0] for row in conn.execute(
+            f'''SELECT key FROM (SELECT key, SUM(LENGTH(value)) OVER (ORDER BY rowid DESC) AS newer_bytes
+                                FROM {responses.table_name})
+               WHERE newer_bytes > ?''', (max_bytes,))]
+
+    cache_session.cache.delete(*stale)
+    responses.vacuum()
+
+
+@traced
+def weather_api(url, params, expire_after):
+
+    # All Open-Meteo requests go through here, so the size limit is checked once per fetch
+    responses = openmeteo.weather_api(url, params=params, expire_after=expire_after)
+    evict_cache()
+
+    return responses
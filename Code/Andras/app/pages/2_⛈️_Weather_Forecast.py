@@ -2,7 +2,16 @@ import streamlit as st
 import numpy as np
 import pandas as pd
 from datetime import datetime, date, timedelta
-from functions import predict_future_damage, get_firestation_data, openmeteo_historical_data, openmeteo_forecast_data, openmeteo_predictors
+from functions import get_firestation_data
+from prediction_cube import forecast_issue_time, latest_issue_time
+from refresh_scheduler import start_scheduler, refresh, health, trigger
+from pipeline_stages import forecast_stages, run_stage, peek_stage, run_untracked
+from map_layers import add_prediction_layer, MAP_ZOOM
+from grid_map import grid_map
+from grid_pyramid import ROLLUP_STATISTICS, rollup_period
+from prediction_index import utc_period
+from instrumentation import span, trace_position, events_since, chrome_trace
+import threading
 import leafmap.foliumap as leafmap
 import geopandas as gpd
 
@@ -15,6 +24,15 @@ st.set_page_config(
 #Sidebar text
 st.sidebar.header("Simulation Page")
 
+# Spans recorded after this point belong to this rerun
+trace_start = trace_position()
+
+# Keep the grid in the browser and only send the probabilities of the selection (grid_map.py)
+fast_map = st.sidebar.toggle("Fast map updates", value=True)
+
+# Score every member of the ensemble forecast, the map then shows the spread for the picked date
+ensemble_mode = st.sidebar.toggle("Ensemble forecast", value=False)
+
 # Set the desired background color
 background_color = "#D9D9D9"  
 st.markdown(
@@ -45,12 +63,25 @@ st.markdown(
     unsafe_allow_html=True
 )
 
-# Load the weather forecast dataframe
-startdate = date.today() - timedelta(days=8)
-forecast_result = openmeteo_forecast_data()
-hist_result = openmeteo_historical_data(start_date = startdate) 
-df_complete = openmeteo_predictors(hist_result, forecast_result)
-df_predictions = predict_future_damage(df_complete)
+# New forecast runs are scored in the background, the page reads the latest finished run.
+# Only on a cold start (nothing published yet) the page waits for a refresh itself.
+stage_log = []
+with span('page: load predictions'):
+    start_scheduler()
+    if latest_issue_time() is None:
+        refresh(ensemble=False)
+    issue_time = latest_issue_time() or forecast_issue_time()
+    hourly_index = run_stage('hourly-index', forecast_stages(issue_time), stage_log)
+
+# Stages the background refresh warms (refresh_scheduler.WARMED_STAGES and the ensemble)
+# are only read by the page. Until they are there, or when they failed, this says so.
+def stage_pending(name, label):
+    error = health()['stage_errors'].get(name)
+    if error:
+        st.warning(f"{label} unavailable: {error}")
+    else:
+        st.info(f"{label} is still being computed by the background refresh, try again in a moment.")
+    trigger()
 
 # Function to get or set the selected date in cache
 @st.cache_data
@@ -85,8 +116,18 @@ with horizontal_container:
             st.write("Report Created!")
 
     with col2:
-        # Data for the alpha value of the boxes
-        data = [0.4,0.5,0.3,0.1,0.1,0.2,0.3,0.5,0.7,0.9,1,0.7]
+        # Alpha value of the boxes: expected damage events of each two hours of the picked
+        # date (the date picker below keeps its value in the session state), relative to the busiest
+        # The hourly index is in UTC, the boxes are local hours from local midnight
+        bar_date = st.session_state.get("date_picker", datetime.now().date())
+        bar_start = utc_period(datetime.combine(bar_date, datetime.min.time()))
+        data = np.zeros(12)
+        if bar_start in hourly_index:
+            profile = np.zeros(24)
+            hours = hourly_index.hourly_profile(bar_start)
+            profile[:len(hours)] = hours
+            data = profile.reshape(12, 2).sum(axis=1)
+            data = np.round(data / max(data.max(), 1e-9), 2)
 
         # Creation of a bar with blocks horizontally, each containing the time range and a color red with an alpha value based on the data
         block_html = ""
@@ -101,7 +142,7 @@ with horizontal_container:
 
 
         # Create a slider for selecting the time of day
-        selected_time = st.slider(f"Select the time of the day", 0, 24, step=1, value=get_or_set_selected_time())
+        selected_time = st.slider(f"Select the time of the day", 0, 23, step=1, value=get_or_set_selected_time())
         # Call the function to update the selected time in cache if it's changed
         if selected_time != get_or_set_selected_time():
             get_or_set_selected_time(selected_time)
@@ -122,40 +163,137 @@ with col1:
     # Run the simulation code
     if runsimulation:
         # code
-        df_selected = df_predictions[df_predictions["date"] == selected_date]
-        df_selected.drop(columns="date", inplace=True)
-        gdf_selected = gpd.GeoDataFrame(df_selected, crs='epsg:28992')
-        st.session_state.manual_map_data = gdf_selected
-        st.write("Simulation Complete!")
+        # The picked (local) hour of the picked date, one (UTC) row of the hourly prediction index
+        selected_hour = utc_period(datetime.combine(selected_date, datetime.min.time()) + timedelta(hours=selected_time))
+        if selected_hour in hourly_index:
+            # Only the hour is kept per session, both maps read the shared hourly index
+            st.session_state.selected_hour = selected_hour
+            st.write("Simulation Complete!")
+        else:
+            st.write("No hourly forecast for this time yet.")
 
     
 
 with col2:
-    # If no simulation has been performed yet, show the default map of amsterdam
-    m = leafmap.Map(center=(52.360, 4.886), zoom=12, google_map="ROADMAP")
+    damage_labels = {"building_proba": "Building damage prediction", "tree_proba": "Tree damage prediction",
+                     "total_proba": "Total damage prediction"}
+
+    map_hour = st.session_state.get("selected_hour")
+    if map_hour is not None and map_hour not in hourly_index:
+        map_hour = None
+
+    # The picked hour of the hourly index, or in ensemble mode a band of the picked date.
+    # The ensemble is scored by the background refresh, the page only reads the result.
+    map_index, map_period, map_label = hourly_index, map_hour, ""
+    if ensemble_mode:
+        bands = peek_stage('ensemble', forecast_stages(issue_time), stage_log)
+        if bands is None:
+            stage_pending('ensemble', "Ensemble forecast")
+        else:
+            band = st.selectbox("Ensemble band", list(bands),
+                                help="Quantiles of the damage probability over the ensemble members, "
+                                     "or the share of members reaching a probability")
+            map_index, map_label = bands[band], f" (ensemble {band}, {selected_date:%d/%m})"
+            map_period = selected_date if selected_date in map_index else None
+
+    if fast_map:
+        # Only the probabilities of the picked hour go to the browser, the grid is already there
+        map_column = st.radio("Damage type", list(damage_labels), format_func=damage_labels.get, horizontal=True)
+        # Zoomed out, the grid cells are merged into coarser cells showing the max or mean of their cells
+        rollup_statistic = st.radio("Zoomed-out cells show", ROLLUP_STATISTICS, horizontal=True)
+        firestationsoverlay = st.checkbox("Show Fire Stations?")
+
+        # Roll-ups of the whole run, without them the zoomed-out cells of the picked hour only
+        rollups = None
+        if map_index is hourly_index:
+            rollups = peek_stage('pyramid', forecast_stages(issue_time), stage_log)
+            if rollups is None:
+                stage_pending('pyramid', "Zoomed-out map")
+
+        def level_frame(level):
+            if map_period is None:
+                return None
+            if level == 0:
+                return map_index.frame(map_period)
+            if rollups is None:
+                return rollup_period(map_index, map_period, level, rollup_statistic)
+            return rollups[(level, rollup_statistic)].frame(map_period)
+
+        label = damage_labels[map_column] + map_label + f" ({rollup_statistic} when zoomed out)"
+        with span('page: grid map'):
+            grid_map(level_frame, map_column, label, show_overlay=firestationsoverlay)
+
+    else:
+        # If no simulation has been performed yet, show the default map of amsterdam
+        m = leafmap.Map(center=(52.360, 4.886), zoom=MAP_ZOOM, google_map="ROADMAP")
     
-    if "manual_map_data" not in st.session_state:
-        pass
+        if map_period is None:
+            pass
     
-    # Otherwise show the last simulation data on the map
-    else:
-        prediction_gdf = st.session_state.manual_map_data
-
-        m.add_data(data=gdf_selected, 
-                    column='building_proba',
-                    cmap = 'Reds',
-                    layer_name='Building damage prediction', 
-                    info_mode='on_click') 
+        # Otherwise show the last simulation data on the map
+        else:
+            with span('page: prediction layer'):
+                add_prediction_layer(m, map_index.frame(map_period), 'building_proba',
+                                     'Building damage prediction' + map_label)
     
-    # Checkbox for toggling the fire station area overlay
-    firestationsoverlay = st.checkbox("Show Fire Stations?")
+        # Checkbox for toggling the fire station area overlay
+        firestationsoverlay = st.checkbox("Show Fire Stations?")
     
-    if firestationsoverlay:
-        db = "Code/data/model_data.sqlite"
-        firestations, service_areas = get_firestation_data(db)
+        if firestationsoverlay:
+            db = "Code/data/model_data.sqlite"
+            with span('page: fire station layers'):
+                firestations, service_areas = get_firestation_data(db)
         
-        m.add_gdf(firestations, layer_name='Firestations')
-        m.add_gdf(service_areas, layer_name='Service area boundaries')
+                m.add_gdf(firestations, layer_name='Firestations')
+                m.add_gdf(service_areas, layer_name='Service area boundaries')
        
-    m.to_streamlit()
-    
\ No newline at end of file
+        run_untracked('render', m.to_streamlit, stage_log)
+
+# Expected incidents per fire station over the forecast horizon, weighed against its vehicles
+st.subheader("Risk per fire station")
+df_station_risk = peek_stage('station-risk', forecast_stages(issue_time), stage_log)
+
+if df_station_risk is None:
+    stage_pending('station-risk', "Risk per fire station")
+
+else:
+    col1, col2 = st.columns([0.4,0.6], gap='large')
+
+    with col1:
+        df_station_day = df_station_risk[df_station_risk["date"] == selected_date]
+        st.dataframe(df_station_day[["Service area", "expected_incidents", "Vehicle Count", "incidents_per_vehicle",
+                                     "Precipitation (mm)", "Maximum wind gust (m/s)"]]
+                     .sort_values("incidents_per_vehicle", ascending=False),
+                     hide_index=True,
+                     column_config={"expected_incidents": st.column_config.NumberColumn("Expected incidents", format="%.2f"),
+                                    "incidents_per_vehicle": st.column_config.NumberColumn("Incidents per vehicle", format="%.2f"),
+                                    "Precipitation (mm)": st.column_config.NumberColumn(format="%.1f"),
+                                    "Maximum wind gust (m/s)": st.column_config.NumberColumn(format="%.1f")})
+
+    with col2:
+        st.line_chart(df_station_risk.pivot(index="date", columns="Service area", values="incidents_per_vehicle"))
+
+# Background refresh status and manual trigger
+with st.sidebar.expander("Forecast refresh"):
+    refresh_health = health()
+    st.write(f"Showing forecast run {issue_time:%d/%m %H:%M} UTC, "
+             f"{refresh_health['lag_runs'] or 0} run(s) behind")
+    st.json({key: str(value) for key, value in refresh_health.items()}, expanded=False)
+    if st.button("Refresh now", key="refresh_now"):
+        trigger()
+
+# Which stages ran, came from the cache or from the prediction cube on this rerun
+with st.sidebar.expander("Pipeline stages"):
+    st.dataframe(pd.DataFrame(stage_log), hide_index=True)
+    
+
+# Time, memory and cache hits of every traced function and page block of this rerun
+with st.sidebar.expander("Performance"):
+    trace_events = events_since(trace_start, thread=threading.get_ident())
+    if trace_events:
+        trace_df = pd.DataFrame(trace_events).sort_values('start')
+        trace_df['name'] = ['· ' * depth + name for depth, name in zip(trace_df['depth'], trace_df['name'])]
+        trace_df = trace_df.reindex(columns=['name', 'seconds', 'cache', 'body_seconds', 'rss_delta_mb', 'peak_delta_mb'])
+        st.dataframe(trace_df, hide_index=True)
+        st.download_button("Export trace", chrome_trace(trace_events), file_name="forecast_trace.json",
+                           mime="application/json")
@@ -8,10 +8,13 @@ from datetime import datetime
 import sqlite3
 import geopandas as gpd
 from shapely import wkt
+from map_layers import add_prediction_layer, MAP_ZOOM
 import leafmap.foliumap as leafmap
 import calendar
 import pickle
 from functions import predict_manual_damage, get_firestation_data
+from prediction_store import run_id, store_run, view_session_run
+from prediction_cube import model_version
 
 st.set_page_config(
     layout="wide",
@@ -96,26 +99,28 @@ with col1:
         # Run the simulation code (put code to run the model here)
         if runsimulation:
             # Run simulation code with the variables from the sliders above
-            # Save the result of the simulation as the map data in the session state
-            st.session_state.manual_map_data = predict_manual_damage(leaveson, rain, windspeed, windgusts, pastwind, pastwindavg, pastwindgusts)
+            # The session only keeps the scenario, the predictions live in the shared store
+            st.session_state.manual_scenario = (leaveson, rain, windspeed, windgusts, pastwind, pastwindavg, pastwindgusts)
             
 
 with col2:
     # If no simulation has been performed yet, show the default map of amsterdam
-    m = leafmap.Map(center=(52.360, 4.886), zoom=12, google_map="ROADMAP")
+    m = leafmap.Map(center=(52.360, 4.886), zoom=MAP_ZOOM, google_map="ROADMAP")
     
-    if "manual_map_data" not in st.session_state:
+    if "manual_scenario" not in st.session_state:
         pass
     
     # Otherwise show the last simulation data on the map
     else:
-        prediction_gdf = st.session_state.manual_map_data
-
-        m.add_data(data=prediction_gdf, 
-                    column='building_proba',
-                    cmap = 'Reds',
-                    layer_name='Building damage prediction', 
-                    info_mode='on_click') 
+        # Sessions running the same scenario share one run, it is predicted again if it was evicted
+        scenario = st.session_state.manual_scenario
+        manual_run = run_id('manual', scenario, model_version())
+        prediction_df = view_session_run(manual_run)
+        if prediction_df is None:
+            store_run(manual_run, lambda: predict_manual_damage(*scenario))
+            prediction_df = view_session_run(manual_run)
+
+        add_prediction_layer(m, prediction_df, 'building_proba', 'Building damage prediction')
     
     # Checkbox for toggling the fire station area overlay
     firestationsoverlay = st.checkbox("Show Fire Stations?")
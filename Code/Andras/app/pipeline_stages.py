@@ -0,0 +1,176 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
+from functions import openmeteo_forecast_data, openmeteo_predictors, openmeteo_forecast_locations, service_area_locations
+from weather_archive import archived_historical_data
+from prediction_cube import model_version, read_prediction_cube, update_prediction_cube
+from instrumentation import span
+from service_areas import load_service_area_index, grid_fingerprint
+from station_risk import station_risk
+from hourly_features import hourly_predictors
+from prediction_index import build_hourly_index, load_hourly_index, utc_period
+from grid_pyramid import pyramid_rollups
+from ensemble import openmeteo_ensemble_data, ensemble_predictors, score_ensemble, ENSEMBLE_MODEL
+from openmeteo_cache import REANALYSIS_LAG_DAYS
+
+DATABASE_PATH = "Code/data/model_data.sqlite"
+
+# The longest rolling predictor looks back two weeks, plus a day so the first local hour of
+# today has a full window
+HISTORY_DAYS = 15
+
+# The archive lags REANALYSIS_LAG_DAYS behind, the forecasts' past days fill that gap
+FORECAST_PAST_DAYS = REANALYSIS_LAG_DAYS + 1
+
+# Results kept per stage (least recently used are dropped first)
+STAGE_CACHE_ENTRIES = 4
+
+_stage_cache = {}
+_lock = threading.Lock()
+
+
+class Stage:
+
+    # One step of the forecast flow. Its fingerprint is built from its own cheap
+    # identifiers (request parameters, forecast run, model hash, ...) and the
+    # fingerprints of its upstream stages, so it is known without running anything.
+    # A key that costs something to compute (model hash, grid fingerprint) is given as a
+    # function and only called when the fingerprint of the stage is needed.
+
+    def __init__(self, name, func, upstream=(), key=(), lookup=None):
+        self.name = name
+        self.func = func
+        self.upstream = upstream
+        self.key = key
+        self.lookup = lookup
+
+
+def fingerprint(name, stages):
+
+    stage = stages[name]
+    key = stage.key() if callable(stage.key) else stage.key
+    digest = hashlib.sha256(f'{stage.name}|{key!r}'.encode())
+    for upstream in stage.upstream:
+        digest.update(fingerprint(upstream, stages).encode())
+
+    return digest.hexdigest()[:16]
+
+
+def cached_result(name, stage_fingerprint):
+
+    with _lock:
+        entries = _stage_cache.setdefault(name, OrderedDict())
+        if stage_fingerprint in entries:
+            entries.move_to_end(stage_fingerprint)
+            return True, entries[stage_fingerprint]
+
+    return False, None
+
+
+def store_result(name, stage_fingerprint, value):
+
+    with _lock:
+        entries = _stage_cache.setdefault(name, OrderedDict())
+        entries[stage_fingerprint] = value
+        while len(entries) > STAGE_CACHE_ENTRIES:
+            entries.popitem(last=False)
+
+
+def run_stage(name, stages, log):
+
+    # Reuse the cached output when the fingerprint is unchanged, otherwise run the
+    # upstream stages (which may be cached themselves) and then this stage.
+    # Cached outputs are shared between sessions, callers must not modify them.
+    stage = stages[name]
+    stage_fingerprint = fingerprint(name, stages)
+    start = time.perf_counter()
+
+    found, value = cached_result(name, stage_fingerprint)
+    status = 'cached'
+
+    if not found and stage.lookup is not None:
+        value = stage.lookup()
+        found = value is not None
+        status = 'stored'
+
+    if not found:
+        inputs = [run_stage(upstream, stages, log) for upstream in stage.upstream]
+        start = time.perf_counter()
+        with span(f'stage: {name}'):
+            value = stage.func(*inputs)
+        status = 'ran'
+
+    if status != 'cached':
+        store_result(name, stage_fingerprint, value)
+
+    log.append({'stage': name, 'status': status, 'fingerprint': stage_fingerprint,
+                'seconds': time.perf_counter() - start})
+
+    return value
+
+
+def peek_stage(name, stages, log):
+
+    # The cached output of a stage, or None when it has not been computed yet. Nothing
+    # runs, for stages that are too slow to score during a page rerun (see refresh_scheduler).
+    stage_fingerprint = fingerprint(name, stages)
+    found, value = cached_result(name, stage_fingerprint)
+    log.append({'stage': name, 'status': 'cached' if found else 'pending', 'fingerprint': stage_fingerprint,
+                'seconds': 0.0})
+
+    return value
+
+
+def forecast_stages(issue_time, history_days=HISTORY_DAYS):
+
+    # fetch -> features -> predict -> station-risk (daily, with the fetched area forecasts) and
+    # fetch -> hourly features -> hourly-index -> pyramid for the Weather Forecast page and
+    # fetch ensemble -> ensemble features -> ensemble (quantile and exceedance bands)
+    today = date.today()
+    start_date = today - timedelta(days=history_days)
+
+    return {
+        'fetch forecast': Stage('fetch forecast', lambda: openmeteo_forecast_data(past_days=FORECAST_PAST_DAYS),
+                                key=(issue_time.isoformat(), FORECAST_PAST_DAYS)),
+        'fetch history': Stage('fetch history', lambda: archived_historical_data(start_date=start_date),
+                               key=(start_date.isoformat(), today.isoformat())),
+        'features': Stage('features', lambda forecast, history: openmeteo_predictors(history, forecast),
+                          upstream=('fetch forecast', 'fetch history'), key=(today.isoformat(),)),
+        'predict': Stage('predict', lambda features: update_prediction_cube(features, issue_time),
+                         upstream=('features',), key=lambda: (model_version(), grid_fingerprint(DATABASE_PATH)),
+                         lookup=lambda: read_prediction_cube(issue_time)),
+        'hourly features': Stage('hourly features',
+                                 lambda forecast, history: hourly_predictors(history, forecast, start=utc_period(today)),
+                                 upstream=('fetch forecast', 'fetch history'), key=(today.isoformat(),)),
+        'hourly-index': Stage('hourly-index', lambda hourly: build_hourly_index(hourly, issue_time),
+                              upstream=('hourly features',),
+                              key=lambda: (model_version(), grid_fingerprint(DATABASE_PATH)),
+                              lookup=lambda: load_hourly_index(issue_time)),
+        'pyramid': Stage('pyramid', pyramid_rollups, upstream=('hourly-index',),
+                         key=lambda: (grid_fingerprint(DATABASE_PATH),)),
+        'fetch ensemble': Stage('fetch ensemble', lambda: openmeteo_ensemble_data(past_days=FORECAST_PAST_DAYS),
+                                key=(issue_time.isoformat(), ENSEMBLE_MODEL, FORECAST_PAST_DAYS)),
+        'ensemble features': Stage('ensemble features',
+                                   lambda ensemble, history: ensemble_predictors(history, ensemble),
+                                   upstream=('fetch ensemble', 'fetch history'), key=(today.isoformat(),)),
+        'ensemble': Stage('ensemble', score_ensemble, upstream=('ensemble features',), key=lambda: (model_version(),)),
+        'fetch area forecast': Stage('fetch area forecast',
+                                     lambda: openmeteo_forecast_locations(service_area_locations(DATABASE_PATH)),
+                                     key=(issue_time.isoformat(),)),
+        'station-risk': Stage('station-risk', station_risk, upstream=('predict', 'fetch area forecast'),
+                              key=lambda: (str(load_service_area_index()['fingerprint']),)),
+    }
+
+
+def run_untracked(name, func, log):
+
+    # Stages without a cacheable output (rendering the map) are only timed
+    start = time.perf_counter()
+    with span(f'stage: {name}'):
+        value = func()
+    log.append({'stage': name, 'status': 'ran', 'fingerprint': '',
+                'seconds': time.perf_counter() - start})
+
+    return value
@@ -0,0 +1,371 @@
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+import datetime as dt
+import numpy as np
+import pandas as pd
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from functions import predict_future_damage
+from service_areas import load_service_area_index
+from prediction_cube import forecast_issue_time, latest_issue_time
+from prediction_index import daily_prediction_index, load_hourly_index, utc_period
+from scoring import get_scorer
+from model_registry import load_report
+from openmeteo_cache import cache_stats, cache_size
+
+# Arrow output is optional, JSON always works
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# The app works with paths relative to the repository root
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+DATABASE_PATH = "Code/data/model_data.sqlite"
+MODEL_PATHS = ['Code/Andras/xgb_building_pipeline.pickle', 'Code/Andras/xgb_tree_pipeline.pickle']
+
+# How often the server looks for a newer forecast run in the prediction cube
+SNAPSHOT_CHECK_SECONDS = 30
+
+# Responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+# Encoded responses kept per snapshot (grid, areas and manual scenarios)
+RESPONSE_CACHE_ENTRIES = 256
+
+PROBA_COLUMNS = ['building_proba', 'tree_proba', 'total_proba']
+
+logger = logging.getLogger('prediction_api')
+
+_snapshot = {'issue_time': None, 'daily': None, 'hourly': None, 'checked': None}
+_responses = {}
+_lock = threading.Lock()
+
+
+def load_snapshot(force=False):
+
+    # Predictions of the latest finished forecast run, reloaded when a newer run is published.
+    # Checked at most every SNAPSHOT_CHECK_SECONDS, also while no run or no hourly index is
+    # there yet (the index is not stored at all for a run with too many missing values)
+    now = time.monotonic()
+    if not force and _snapshot['checked'] is not None and now - _snapshot['checked'] < SNAPSHOT_CHECK_SECONDS:
+        return _snapshot
+
+    with _lock:
+        issue_time = latest_issue_time()
+        if issue_time is not None and issue_time != _snapshot['issue_time']:
+            _snapshot['daily'] = daily_prediction_index(issue_time)
+            _snapshot['hourly'] = None
+            _snapshot['issue_time'] = issue_time
+            _responses.clear()
+
+        # The hourly predictions of a run are published after the daily ones
+        if issue_time is not None and _snapshot['hourly'] is None:
+            _snapshot['hourly'] = load_hourly_index(issue_time)
+        _snapshot['checked'] = now
+
+    return _snapshot
+
+
+def grid_predictions(day, hour=None):
+
+    # One hour from the hourly index, or the whole day from the daily one
+    snapshot = load_snapshot()
+    if snapshot['daily'] is None:
+        raise LookupError('No forecast run has been published yet')
+
+    # The hour is local time, the hourly index is in UTC
+    if hour is not None:
+        selected = utc_period(dt.datetime.combine(day, dt.time(hour)))
+        if snapshot['hourly'] is None or selected not in snapshot['hourly']:
+            raise LookupError(f'No hourly predictions for {selected}')
+        return snapshot['hourly'].frame(selected)
+
+    if day not in snapshot['daily']:
+        periods = snapshot['daily'].periods
+        raise LookupError(f'No predictions for {day}, available: {periods.min().date()} to {periods.max().date()}')
+
+    return snapshot['daily'].frame(day)
+
+
+def service_area_aggregates(prediction_df, database_path=DATABASE_PATH):
+
+    # Per service area: (area-weighted) number of cells, mean and maximum probabilities and
+    # the expected number of damage events (sum of the weighted probabilities)
+    index = load_service_area_index(database_path)
+    values = np.full((int(index['n_cells']), len(PROBA_COLUMNS)), np.nan)
+    values[prediction_df['cell_id'].to_numpy()] = prediction_df[PROBA_COLUMNS].to_numpy()
+
+    pairs = values[index['cell_id']]
+    weights = index['fraction'].astype(np.float64)
+    frame = pd.DataFrame(pairs, columns=PROBA_COLUMNS)
+    frame['service_area'] = index['area_names'][index['area']]
+    frame['cells'] = np.where(np.isnan(pairs[:, 0]), 0, weights)
+    for column in PROBA_COLUMNS:
+        frame[f'{column}_weighted'] = frame[column] * weights
+
+    grouped = frame.groupby('service_area')
+    aggregates = grouped[['cells']].sum()
+    for column in PROBA_COLUMNS:
+        aggregates[f'{column}_mean'] = grouped[f'{column}_weighted'].sum() / aggregates['cells']
+    for column in PROBA_COLUMNS:
+        aggregates[f'{column}_max'] = grouped[column].max()
+    aggregates['expected_events'] = grouped['total_proba_weighted'].sum()
+
+    return aggregates.reset_index()
+
+
+def grid_columns(database_path=DATABASE_PATH):
+
+    with sqlite3.connect(database_path) as conn:
+        return [row[1] for row in conn.execute('PRAGMA table_info("AMS_grid_blocks")')]
+
+
+def scenario_inputs(values, model_paths=MODEL_PATHS):
+
+    # Weather inputs of a manual storm: every weather feature of the models must be given
+    weather_columns = set()
+    for path in model_paths:
+        weather_columns |= set(get_scorer(path).feature_names)
+    weather_columns -= set(grid_columns())
+
+    missing = sorted(weather_columns - set(values))
+    if missing:
+        raise ValueError(f'Missing scenario inputs: {", ".join(missing)}')
+
+    scenario = {column: [float(values[column])] for column in sorted(weather_columns)}
+    scenario['date'] = [dt.date.today()]
+
+    return pd.DataFrame(scenario)
+
+
+def manual_predictions(values):
+
+    # Same scoring path as the forecast, with a single "day" holding the scenario
+    return predict_future_damage(scenario_inputs(values)).drop(columns='date')
+
+
+def encode(frame, fmt):
+
+    # JSON as column lists (compact and fast to build), Arrow as an IPC stream
+    if fmt == 'arrow':
+        if pyarrow is None:
+            raise ValueError('Arrow output needs pyarrow, install it or use format=json')
+        table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+        sink = io.BytesIO()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue(), 'application/vnd.apache.arrow.stream'
+
+    if fmt == 'json':
+        columns = {column: frame[column].tolist() for column in frame.columns}
+        return json.dumps(columns, default=str).encode(), 'application/json'
+
+    raise ValueError(f'Unknown format: {fmt}')
+
+
+def cached_response(key, build):
+
+    # Encoded bodies are reused until the next snapshot, so repeated requests cost a dict lookup
+    with _lock:
+        if key in _responses:
+            return _responses[key]
+
+    body, content_type = build()
+    compressed = gzip.compress(body, compresslevel=5) if len(body) >= GZIP_MIN_BYTES else None
+
+    with _lock:
+        if len(_responses) >= RESPONSE_CACHE_ENTRIES:
+            _responses.pop(next(iter(_responses)))
+        _responses[key] = (body, compressed, content_type)
+
+    return _responses[key]
+
+
+def parse_date(value):
+
+    return dt.date.today() if value is None else dt.date.fromisoformat(value)
+
+
+def parse_hour(value):
+
+    if value is None:
+        return None
+    hour = int(value)
+    if not 0 <= hour <= 23:
+        raise ValueError(f'Hour must be between 0 and 23, got {hour}')
+
+    return hour
+
+
+def handle(path, query, body=None):
+
+    # Returns (status, body, gzipped body or None, content type) for a request
+    fmt = query.get('format', 'json')
+    snapshot = load_snapshot()
+    version = str(snapshot['issue_time'])
+
+    if path == '/health':
+        status = {'issue_time': version, 'expected_issue_time': str(forecast_issue_time()),
+                  'days': [] if snapshot['daily'] is None else [str(day.date()) for day in snapshot['daily'].periods],
+                  'hourly': snapshot['hourly'] is not None, 'cached_responses': len(_responses),
+                  'models': load_report(), 'openmeteo_cache': dict(cache_stats, size_bytes=cache_size())}
+        plain, content_type = encode_json(status)
+        return 200, plain, None, content_type
+
+    if path == '/predictions':
+        day = parse_date(query.get('date'))
+        # Without an hour the daily predictions, with one the hourly predictions of that hour
+        hour = parse_hour(query.get('hour'))
+        return (200,) + cached_response(('predictions', version, day, hour, fmt),
+                                        lambda: encode(grid_predictions(day, hour), fmt))
+
+    if path == '/areas':
+        day = parse_date(query.get('date'))
+        hour = parse_hour(query.get('hour'))
+        return (200,) + cached_response(('areas', version, day, hour, fmt),
+                                        lambda: encode(service_area_aggregates(grid_predictions(day, hour)), fmt))
+
+    if path == '/manual':
+        values = json.loads(body or b'{}')
+        if not isinstance(values, dict):
+            raise ValueError('The scenario must be a JSON object with a value per weather input')
+        key = ('manual', json.dumps(values, sort_keys=True), query.get('aggregate'), fmt)
+        if query.get('aggregate') == 'areas':
+            return (200,) + cached_response(key, lambda: encode(service_area_aggregates(manual_predictions(values)), fmt))
+        return (200,) + cached_response(key, lambda: encode(manual_predictions(values), fmt))
+
+    raise FileNotFoundError(f'Unknown path: {path}')
+
+
+def encode_json(value):
+
+    return json.dumps(value, default=str).encode(), 'application/json'
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 keeps connections open between requests
+    protocol_version = 'HTTP/1.1'
+
+    # Headers and body are written separately, without this every response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.respond(self.rfile.read(length) if length else None)
+
+    def respond(self, body=None):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            status, plain, compressed, content_type = handle(url.path, query, body)
+        except FileNotFoundError as error:
+            status, (plain, content_type), compressed = 404, encode_json({'error': str(error)}), None
+        except LookupError as error:
+            status, (plain, content_type), compressed = 404, encode_json({'error': str(error)}), None
+        except ValueError as error:
+            status, (plain, content_type), compressed = 400, encode_json({'error': str(error)}), None
+        except Exception:
+            # Anything else is a bug or a broken data file, the client gets no details
+            logger.exception('%s %s failed', self.command, self.path)
+            status, (plain, content_type), compressed = 500, encode_json({'error': 'Internal server error'}), None
+
+        use_gzip = compressed is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        payload = compressed if use_gzip else plain
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # One line per request is too much at hundreds of requests per second
+        pass
+
+
+def serve(host='127.0.0.1', port=8600):
+
+    load_snapshot(force=True)
+    server = ThreadingHTTPServer((host, port), PredictionHandler)
+    server.daemon_threads = True
+    print(f'Serving predictions of forecast run {_snapshot["issue_time"]} on http://{host}:{port}')
+    server.serve_forever()
+
+
+def write_output(body, output):
+
+    if output is None:
+        sys.stdout.buffer.write(body)
+    else:
+        with open(output, 'wb') as output_file:
+            output_file.write(body)
+
+
+def main(argv=None):
+
+    # python Code/Andras/app/prediction_api.py serve --port 8600
+    # python Code/Andras/app/prediction_api.py predictions --date 2024-01-02 --format arrow --output grid.arrow
+    # python Code/Andras/app/prediction_api.py areas --date 2024-01-02
+    # python Code/Andras/app/prediction_api.py manual scenario.json --aggregate areas
+    parser = argparse.ArgumentParser(description='Storm damage predictions without the dashboard')
+    parser.add_argument('--root', default=REPO_ROOT, help='repository root (the data paths are relative to it)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8600)
+
+    for name in ['predictions', 'areas']:
+        command = commands.add_parser(name)
+        command.add_argument('--date')
+        command.add_argument('--hour', type=int)
+        command.add_argument('--format', default='json', choices=['json', 'arrow'])
+        command.add_argument('--output')
+
+    manual_parser = commands.add_parser('manual')
+    manual_parser.add_argument('scenario', help='JSON file with a value for every weather input of the models')
+    manual_parser.add_argument('--aggregate', choices=['areas'])
+    manual_parser.add_argument('--format', default='json', choices=['json', 'arrow'])
+    manual_parser.add_argument('--output')
+
+    args = parser.parse_args(argv)
+    os.chdir(args.root)
+
+    if args.command == 'serve':
+        serve(args.host, args.port)
+        return
+
+    query = {'format': args.format}
+    body = None
+    if args.command == 'manual':
+        with open(args.scenario, 'rb') as scenario_file:
+            body = scenario_file.read()
+        if args.aggregate:
+            query['aggregate'] = args.aggregate
+    else:
+        query.update({key: str(value) for key, value in [('date', args.date), ('hour', args.hour)]
+                      if value is not None})
+
+    _, plain, _, _ = handle(f'/{args.command}', query, body)
+    write_output(plain, args.output)
+
+
+if __name__ == '__main__':
+    main()
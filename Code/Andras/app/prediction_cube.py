@@ -0,0 +1,194 @@
+import sqlite3
+import hashlib
+import datetime as dt
+from contextlib import closing
+import numpy as np
+import pandas as pd
+from functions import iter_future_damage, total_probability
+from model_registry import model_hash, model_features
+from service_areas import grid_fingerprint
+from openmeteo_cache import published_run
+
+# The cube lives next to model_data.sqlite
+CUBE_PATH = "Code/data/prediction_cube.sqlite"
+MODEL_PATHS = ['Code/Andras/xgb_building_pipeline.pickle', 'Code/Andras/xgb_tree_pipeline.pickle']
+
+# Forecast runs kept per model version and grid, older runs and their periods are pruned
+RUNS_KEPT = 4
+
+
+def forecast_issue_time(now=None):
+
+    # Start (naive UTC) of the newest model run that has been published
+    return published_run(now)
+
+
+def model_version(model_paths=MODEL_PATHS):
+
+    # Content hash of the pickled pipelines, so a retrained model gets a new version
+    digest = hashlib.sha256()
+    for path in model_paths:
+        digest.update(model_hash(path).encode())
+
+    return digest.hexdigest()[:16]
+
+
+def model_input_columns(model_paths=MODEL_PATHS):
+
+    columns = set()
+    for path in model_paths:
+        columns |= set(model_features(path))
+
+    return columns
+
+
+def predictor_hashes(forecast_df, columns):
+
+    # One hash per forecast period over the predictor values the models actually use
+    columns = sorted(c for c in forecast_df.columns if c in columns)
+    values = np.ascontiguousarray(forecast_df[columns].to_numpy(dtype=np.float64))
+
+    return [hashlib.sha1(row.tobytes()).hexdigest() for row in values]
+
+
+def connect_cube(cube_path=CUBE_PATH):
+
+    # Callers close it with contextlib.closing, the connection as context manager only commits
+    conn = sqlite3.connect(cube_path)
+
+    # Cubes written before the grid was part of the key are scored again
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(forecast_runs)')}
+    if columns and 'grid' not in columns:
+        with conn:
+            conn.execute('DROP TABLE forecast_runs')
+            conn.execute('DROP TABLE IF EXISTS prediction_periods')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS forecast_runs (
+                        issue_time TEXT, model_version TEXT, grid TEXT, period TEXT, predictor_hash TEXT,
+                        PRIMARY KEY (issue_time, model_version, grid, period))''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS prediction_periods (
+                        model_version TEXT, grid TEXT, predictor_hash TEXT, building_proba BLOB, tree_proba BLOB,
+                        PRIMARY KEY (model_version, grid, predictor_hash))''')
+
+    return conn
+
+
+def read_prediction_arrays(issue_time, version=None, cube_path=CUBE_PATH, grid=None):
+
+    # Periods of a stored run with its (periods x cells) building and tree probabilities
+    if version is None:
+        version = model_version()
+    if grid is None:
+        grid = grid_fingerprint()
+
+    with closing(connect_cube(cube_path)) as conn:
+        rows = conn.execute('''SELECT r.period, p.building_proba, p.tree_proba
+                               FROM forecast_runs r JOIN prediction_periods p
+                               USING (model_version, grid, predictor_hash)
+                               WHERE r.issue_time = ? AND r.model_version = ? AND r.grid = ?
+                               ORDER BY r.period''',
+                            (issue_time.isoformat(), version, grid)).fetchall()
+
+    # Nothing stored yet for this forecast run
+    if not rows:
+        return None
+
+    periods = [dt.date.fromisoformat(row[0]) for row in rows]
+    building_proba = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+    tree_proba = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+
+    return periods, building_proba, tree_proba
+
+
+def read_prediction_cube(issue_time, version=None, cube_path=CUBE_PATH, grid=None):
+
+    arrays = read_prediction_arrays(issue_time, version, cube_path, grid)
+    if arrays is None:
+        return None
+
+    # Stored per period, returned cell-major like predict_future_damage
+    periods, building_proba, tree_proba = arrays
+    n_periods, n_cells = building_proba.shape
+
+    prediction_df = pd.DataFrame({'cell_id': np.repeat(np.arange(n_cells), n_periods),
+                                  'date': np.tile(np.array(periods, dtype=object), n_cells),
+                                  'building_proba': building_proba.T.ravel(),
+                                  'tree_proba': tree_proba.T.ravel()})
+    prediction_df['total_proba'] = total_probability(prediction_df['building_proba'], prediction_df['tree_proba'])
+
+    return prediction_df
+
+
+def latest_issue_time(version=None, cube_path=CUBE_PATH, grid=None):
+
+    # Newest forecast run that has been stored completely for this model version and grid
+    if version is None:
+        version = model_version()
+    if grid is None:
+        grid = grid_fingerprint()
+
+    with closing(connect_cube(cube_path)) as conn:
+        row = conn.execute('SELECT MAX(issue_time) FROM forecast_runs WHERE model_version = ? AND grid = ?',
+                           (version, grid)).fetchone()
+
+    return None if row[0] is None else dt.datetime.fromisoformat(row[0])
+
+
+def update_prediction_cube(forecast_df, issue_time, cube_path=CUBE_PATH):
+
+    version = model_version()
+    grid = grid_fingerprint()
+    forecast_df = forecast_df.reset_index(drop=True)
+    hashes = predictor_hashes(forecast_df, model_input_columns())
+
+    # One transaction, so readers see either the whole run or none of it
+    with closing(connect_cube(cube_path)) as conn, conn:
+        # Periods whose predictor values were already scored by this model version and grid
+        known = {row[0] for row in conn.execute(
+            'SELECT predictor_hash FROM prediction_periods WHERE model_version = ? AND grid = ?', (version, grid))}
+        changed = {}
+        for index, predictor_hash in enumerate(hashes):
+            if predictor_hash not in known and predictor_hash not in changed:
+                changed[predictor_hash] = index
+        changed = list(changed.values())
+
+        # Only score the periods that changed since the previous runs
+        if changed:
+            scored = pd.concat(iter_future_damage(forecast_df.iloc[changed]), ignore_index=True)
+            n_changed = len(changed)
+
+            for position, index in enumerate(changed):
+                period = scored.iloc[position::n_changed]
+                conn.execute('INSERT OR REPLACE INTO prediction_periods VALUES (?, ?, ?, ?, ?)',
+                             (version, grid, hashes[index],
+                              period['building_proba'].to_numpy(np.float32).tobytes(),
+                              period['tree_proba'].to_numpy(np.float32).tobytes()))
+
+        conn.executemany('INSERT OR REPLACE INTO forecast_runs VALUES (?, ?, ?, ?, ?)',
+                         [(issue_time.isoformat(), version, grid, forecast_df['date'].iloc[i].isoformat(), h)
+                          for i, h in enumerate(hashes)])
+
+        prune_cube(conn, version, grid)
+
+    return read_prediction_cube(issue_time, version, cube_path, grid)
+
+
+def prune_cube(conn, version, grid, runs_kept=RUNS_KEPT):
+
+    # Runs older than the newest runs_kept of the current model version and grid are superseded,
+    # as are all runs of other versions and grids. Periods no kept run refers to go with them.
+    oldest_kept = conn.execute('''SELECT MIN(issue_time) FROM (
+                                      SELECT DISTINCT issue_time FROM forecast_runs
+                                      WHERE model_version = ? AND grid = ?
+                                      ORDER BY issue_time DESC LIMIT ?)''',
+                               (version, grid, runs_kept)).fetchone()[0]
+    if oldest_kept is None:
+        return
+
+    conn.execute('DELETE FROM forecast_runs WHERE issue_time < ? OR model_version != ? OR grid != ?',
+                 (oldest_kept, version, grid))
+    conn.execute('''DELETE FROM prediction_periods WHERE NOT EXISTS (
+                        SELECT 1 FROM forecast_runs r
+                        WHERE r.model_version = prediction_periods.model_version
+                        AND r.grid = prediction_periods.grid
+                        AND r.predictor_hash = prediction_periods.predictor_hash)''')
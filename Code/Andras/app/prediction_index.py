@@ -0,0 +1,171 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from functions import iter_future_damage, total_probability
+from prediction_cube import model_version, read_prediction_arrays, RUNS_KEPT
+from service_areas import grid_fingerprint
+from instrumentation import traced
+
+# Hourly predictions of a forecast run, one memory-mapped .npy file per probability column
+INDEX_DIR = "Code/data/prediction_index"
+
+# Days with hourly predictions (the date picker offers today up to a week ahead)
+HOURLY_DAYS = 8
+
+PROBA_COLUMNS = ['building_proba', 'tree_proba']
+
+# Hourly periods are naive UTC like the Open-Meteo timestamps, the pages pick local hours
+LOCAL_TIMEZONE = 'Europe/Amsterdam'
+
+# A run with more missing predictor values than this is not stored (e.g. a gap between the
+# weather archive and the forecast would be scored as if there had been no weather)
+MAX_MISSING_FRACTION = 0.01
+
+
+class PredictionIndex:
+
+    # Predictions partitioned by period (a date or an hour): every period is one contiguous
+    # row of probabilities in the shared cell order (row position = cell_id), so selecting a
+    # date or an hour is a dictionary lookup and a slice, without scanning the cube.
+
+    def __init__(self, periods, arrays):
+        self.periods = pd.DatetimeIndex(periods)
+        self.arrays = arrays
+        self.positions = {period: row for row, period in enumerate(self.periods)}
+        self.n_cells = arrays[PROBA_COLUMNS[0]].shape[1]
+
+    def __contains__(self, period):
+        return pd.Timestamp(period) in self.positions
+
+    def rows(self, start, stop, column):
+        if column == 'total_proba' and column not in self.arrays:
+            return total_probability(self.arrays['building_proba'][start:stop], self.arrays['tree_proba'][start:stop])
+        return self.arrays[column][start:stop]
+
+    def period(self, period, column='building_proba'):
+        row = self.positions[pd.Timestamp(period)]
+        return self.rows(row, row + 1, column)[0]
+
+    def frame(self, period):
+        # The selection in the layout of the prediction frames, without a date column
+        row = self.positions[pd.Timestamp(period)]
+        prediction_df = pd.DataFrame({'cell_id': np.arange(self.n_cells)})
+        for column in PROBA_COLUMNS + ['total_proba']:
+            prediction_df[column] = self.rows(row, row + 1, column)[0]
+        return prediction_df
+
+    def day(self, start, column='building_proba'):
+        # (hours x cells) block of the 24 hours from start (a local midnight, see utc_period),
+        # the hours are consecutive rows. Shorter at the end of the index.
+        start = self.positions[pd.Timestamp(start)]
+        return self.rows(start, start + 24, column)
+
+    def hourly_profile(self, start, column='total_proba'):
+        # Expected number of damage events per hour of the day, over the whole grid
+        return self.day(start, column).sum(axis=1, dtype=np.float64)
+
+
+def utc_period(local_time):
+
+    # Hourly period (naive UTC) of a local wall-clock time. Of the repeated autumn hour the
+    # first one is taken, the skipped spring hour moves on to the next hour.
+    local = pd.Timestamp(local_time).tz_localize(LOCAL_TIMEZONE, ambiguous=True, nonexistent='shift_forward')
+
+    return local.tz_convert('UTC').tz_localize(None)
+
+
+def daily_prediction_index(issue_time):
+
+    # The daily periods of a stored run straight from the prediction cube
+    arrays = read_prediction_arrays(issue_time)
+    if arrays is None:
+        return None
+    periods, building_proba, tree_proba = arrays
+
+    return PredictionIndex(periods, {'building_proba': building_proba, 'tree_proba': tree_proba})
+
+
+def index_path(issue_time, version=None, grid=None):
+
+    # One directory per run, model version and grid, an edited grid is scored again
+    if version is None:
+        version = model_version()
+    if grid is None:
+        grid = grid_fingerprint()
+
+    return os.path.join(INDEX_DIR, f'{issue_time:%Y%m%d%H}_{version}_{grid}')
+
+
+def load_hourly_index(issue_time):
+
+    # None when the hourly predictions of this run have not been stored yet
+    path = index_path(issue_time)
+    if not os.path.exists(os.path.join(path, 'periods.json')):
+        return None
+
+    with open(os.path.join(path, 'periods.json')) as periods_file:
+        periods = json.load(periods_file)
+    arrays = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r') for column in PROBA_COLUMNS}
+
+    return PredictionIndex(periods, arrays)
+
+
+def save_hourly_index(index, issue_time):
+
+    # The periods file is written last, a run without it is incomplete and ignored
+    path = index_path(issue_time)
+    os.makedirs(path, exist_ok=True)
+    for column in PROBA_COLUMNS:
+        np.save(os.path.join(path, f'{column}.npy'), np.ascontiguousarray(index.arrays[column]))
+
+    temporary_path = os.path.join(path, f'periods.json.{os.getpid()}.tmp')
+    with open(temporary_path, 'w') as periods_file:
+        json.dump([period.isoformat() for period in index.periods], periods_file)
+    os.replace(temporary_path, os.path.join(path, 'periods.json'))
+
+
+def remove_old_indexes(runs_kept=RUNS_KEPT):
+
+    # Indexes of runs the prediction cube no longer keeps either; open maps stay valid
+    if not os.path.isdir(INDEX_DIR):
+        return []
+    names = [name for name in os.listdir(INDEX_DIR) if os.path.isdir(os.path.join(INDEX_DIR, name))]
+    kept = sorted({name.split('_')[0] for name in names}, reverse=True)[:runs_kept]
+
+    removed = [name for name in names if name.split('_')[0] not in kept]
+    for name in removed:
+        shutil.rmtree(os.path.join(INDEX_DIR, name), ignore_errors=True)
+
+    return removed
+
+
+@traced
+def build_hourly_index(hourly_df, issue_time, days=HOURLY_DAYS):
+
+    # Score every hour of the first days from the first hour of hourly_df (the local midnight
+    # the stage starts it at); hourly_df comes from hourly_features.hourly_predictors
+    start = pd.Timestamp(hourly_df['timestamp'].iloc[0])
+    hourly_df = hourly_df[(hourly_df['timestamp'] >= start) &
+                          (hourly_df['timestamp'] < start + pd.Timedelta(days=days))]
+
+    # Whole days only, so every day is 24 consecutive rows
+    n_hours = len(hourly_df) - len(hourly_df) % 24
+    hourly_df = hourly_df.iloc[:n_hours].drop(columns='date').rename(columns={'timestamp': 'date'})
+
+    missing = hourly_df.drop(columns='date').isna().mean()
+    if (missing > MAX_MISSING_FRACTION).any():
+        raise ValueError('Too many hours without predictor values: ' +
+                         ', '.join(f'{column} {share:.0%}' for column, share in missing.items()
+                                   if share > MAX_MISSING_FRACTION))
+
+    scored = pd.concat(iter_future_damage(hourly_df), ignore_index=True)
+
+    # Scored cell-major, stored hour-major
+    arrays = {column: np.ascontiguousarray(scored[column].to_numpy(np.float32).reshape(-1, n_hours).T)
+              for column in PROBA_COLUMNS}
+    index = PredictionIndex(hourly_df['date'].to_numpy(), arrays)
+    save_hourly_index(index, issue_time)
+
+    return index
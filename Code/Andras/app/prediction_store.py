@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from instrumentation import traced
+
+# Prediction runs shared by all sessions: sessions keep the run id, the probabilities are
+# kept once per server. The arrays are .npy files opened memory-mapped, in RAM-backed
+# /dev/shm where there is one, so worker processes of the same host share the pages too.
+STORE_DIR = "/dev/shm/storm_predictions" if os.path.isdir("/dev/shm") else "Code/data/prediction_store"
+
+STORE_COLUMNS = ['building_proba', 'tree_proba', 'total_proba']
+
+# A session that has not rerun for this long no longer counts as viewing its run
+SESSION_TIMEOUT_SECONDS = 30 * 60
+
+# Runs without viewers stay this long (a session switching back does not recompute)
+EVICT_AFTER_SECONDS = 5 * 60
+
+# Other processes' claims on a run expire when not refreshed for this long (crashed workers)
+LEASE_SECONDS = 60 * 60
+
+_runs = {}
+_views = {}
+_lock = threading.Lock()
+
+
+def run_id(*parts):
+
+    # Content key of a run: what was predicted (scenario, forecast run, model version, ...)
+    return hashlib.sha256(repr(parts).encode()).hexdigest()[:16]
+
+
+def run_path(run):
+
+    return os.path.join(STORE_DIR, run)
+
+
+def lease_path(run):
+
+    return os.path.join(run_path(run), f'{os.getpid()}.lease')
+
+
+def write_run(run, prediction_df):
+
+    # Written to a private directory and renamed into place, a run is never seen half written
+    path = run_path(run)
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    os.makedirs(temporary_path)
+    for column in STORE_COLUMNS:
+        np.save(os.path.join(temporary_path, f'{column}.npy'), prediction_df[column].to_numpy(np.float32))
+    np.save(os.path.join(temporary_path, 'cell_id.npy'), prediction_df['cell_id'].to_numpy(np.int32))
+    with open(os.path.join(temporary_path, 'run.json'), 'w') as run_file:
+        json.dump({'rows': len(prediction_df), 'created': time.time()}, run_file)
+
+    try:
+        os.rename(temporary_path, path)
+    except OSError:
+        # Another process stored the same run first
+        shutil.rmtree(temporary_path, ignore_errors=True)
+
+
+def map_run(run):
+
+    path = run_path(run)
+    if not os.path.exists(os.path.join(path, 'run.json')):
+        return None
+
+    arrays = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r')
+              for column in ['cell_id'] + STORE_COLUMNS}
+
+    return pd.DataFrame(arrays, copy=False)
+
+
+@traced
+def store_run(run, predict):
+
+    # The run from the store, or predict() stored under its id when no process has it
+    with _lock:
+        if run in _runs:
+            return run
+
+    frame = map_run(run)
+    if frame is None:
+        os.makedirs(STORE_DIR, exist_ok=True)
+        remove_stale_runs(time.time())
+        write_run(run, predict())
+        frame = map_run(run)
+
+    with _lock:
+        _runs.setdefault(run, {'frame': frame, 'viewers': set(), 'idle_since': time.time()})
+    touch_lease(run)
+
+    return run
+
+
+def touch_lease(run):
+
+    # Tells other processes this one still maps the run
+    try:
+        with open(lease_path(run), 'a'):
+            os.utime(lease_path(run))
+    except OSError:
+        pass
+
+
+def view_run(run, viewer, slot='map'):
+
+    # The frame of a run for one session (viewer) and place on a page (slot). A session
+    # holds one run per slot, switching releases the previous one. None when the run was
+    # evicted, the caller computes it again.
+    now = time.time()
+    with _lock:
+        previous = _views.get((viewer, slot))
+        if previous is not None and previous[0] != run:
+            release(previous[0], (viewer, slot), now)
+
+        if run is None or run not in _runs:
+            _views.pop((viewer, slot), None)
+            return None
+
+        _views[(viewer, slot)] = (run, now)
+        _runs[run]['viewers'].add((viewer, slot))
+        frame = _runs[run]['frame']
+
+    touch_lease(run)
+    sweep(session_is_active)
+
+    return frame
+
+
+def current_session():
+
+    ctx = get_script_run_ctx()
+
+    return None if ctx is None else ctx.session_id
+
+
+def session_is_active(session_id):
+
+    # Closed browser tabs release their runs right away, not only after the timeout
+    if not runtime.exists():
+        return True
+
+    return runtime.get_instance().is_active_session(session_id)
+
+
+def view_session_run(run, slot='map'):
+
+    # view_run for the session of the current script run
+    return view_run(run, current_session(), slot)
+
+
+def release(run, holder, now):
+
+    # Called with the lock held
+    if run in _runs:
+        _runs[run]['viewers'].discard(holder)
+        if not _runs[run]['viewers']:
+            _runs[run]['idle_since'] = now
+
+
+def sweep(is_active=None):
+
+    # Drop views of sessions that are gone or quiet, then the runs nobody views. The files
+    # of a run are removed by the last process that still had a lease on it.
+    now = time.time()
+    with _lock:
+        for holder, (run, seen) in list(_views.items()):
+            gone = is_active is not None and not is_active(holder[0])
+            if gone or now - seen > SESSION_TIMEOUT_SECONDS:
+                del _views[holder]
+                release(run, holder, now)
+
+        evicted = [run for run, entry in _runs.items()
+                   if not entry['viewers'] and now - entry['idle_since'] > EVICT_AFTER_SECONDS]
+        for run in evicted:
+            del _runs[run]
+
+    for run in evicted:
+        remove_run_files(run, now)
+
+    return evicted
+
+
+def remove_run_files(run, now):
+
+    try:
+        os.remove(lease_path(run))
+        leases = [name for name in os.listdir(run_path(run)) if name.endswith('.lease')
+                  and now - os.path.getmtime(os.path.join(run_path(run), name)) < LEASE_SECONDS]
+    except OSError:
+        return
+
+    # Open maps of the files stay valid after removal
+    if not leases:
+        shutil.rmtree(run_path(run), ignore_errors=True)
+
+
+def remove_stale_runs(now):
+
+    # Runs left behind by processes that exited without evicting them
+    for name in os.listdir(STORE_DIR):
+        path = os.path.join(STORE_DIR, name)
+        if name.endswith('.tmp') or name in _runs or not os.path.isdir(path):
+            continue
+        try:
+            leases = [lease for lease in os.listdir(path) if lease.endswith('.lease')
+                      and now - os.path.getmtime(os.path.join(path, lease)) < LEASE_SECONDS]
+            stale = not leases and now - os.path.getmtime(path) > LEASE_SECONDS
+        except OSError:
+            continue
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def store_stats():
+
+    with _lock:
+        return pd.DataFrame([{'run': run, 'viewers': len(entry['viewers']), 'rows': len(entry['frame']),
+                              'idle_seconds': 0 if entry['viewers'] else time.time() - entry['idle_since']}
+                             for run, entry in _runs.items()],
+                            columns=['run', 'viewers', 'rows', 'idle_seconds'])
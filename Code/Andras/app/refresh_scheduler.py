@@ -0,0 +1,142 @@
+import sys
+import time
+import threading
+import datetime as dt
+from prediction_cube import forecast_issue_time, latest_issue_time
+from pipeline_stages import forecast_stages, run_stage
+from prediction_index import load_hourly_index, remove_old_indexes
+from openmeteo_cache import FORECAST_RUN_INTERVAL_HOURS, utc_time
+
+# How often the scheduler checks whether a new forecast run has to be scored
+POLL_INTERVAL_SECONDS = 5 * 60
+
+# Wait after a failed refresh before trying again
+RETRY_INTERVAL_SECONDS = 60
+
+status = {'started': None, 'last_check': None, 'last_success': None, 'last_error': None,
+          'last_duration_seconds': None, 'published_issue_time': None, 'runs': 0, 'failures': 0,
+          'stage_errors': {}}
+
+# Stages the pages only read (peek_stage), warmed after every refresh. A failure is recorded
+# in status['stage_errors'] and does not fail the refresh. The ensemble is the slow one.
+WARMED_STAGES = ['pyramid', 'station-risk']
+
+_status_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_ensemble_lock = threading.Lock()
+_wake = threading.Event()
+_thread = None
+
+
+def refresh(now=None, ensemble=True):
+
+    # Score the current forecast run (daily and hourly) unless it has been stored already.
+    # update_prediction_cube writes the run in one transaction, so pages reading the
+    # cube only ever see finished runs. The stages the page only reads from the stage cache
+    # (peek_stage) are warmed here as well; the ensemble after the refresh lock is released,
+    # so a page waiting on a cold start does not wait for it.
+    issue_time = forecast_issue_time(now)
+    start = time.perf_counter()
+
+    with _refresh_lock:
+        with _status_lock:
+            status['last_check'] = dt.datetime.now()
+
+        try:
+            stages = forecast_stages(issue_time)
+            if latest_issue_time() != issue_time:
+                run_stage('predict', stages, [])
+            if load_hourly_index(issue_time) is None:
+                run_stage('hourly-index', stages, [])
+            remove_old_indexes()
+        except Exception as error:
+            with _status_lock:
+                status['failures'] += 1
+                status['last_error'] = f'{dt.datetime.now():%Y-%m-%d %H:%M:%S} {error!r}'
+            return False
+
+        with _status_lock:
+            status['runs'] += 1
+            status['last_success'] = dt.datetime.now()
+            status['last_duration_seconds'] = time.perf_counter() - start
+            status['published_issue_time'] = latest_issue_time()
+
+        for name in WARMED_STAGES:
+            warm_stage(name, stages)
+
+    if ensemble:
+        with _ensemble_lock:
+            warm_stage('ensemble', stages)
+
+    return True
+
+
+def warm_stage(name, stages):
+
+    try:
+        run_stage(name, stages, [])
+        error = None
+    except Exception as stage_error:
+        error = f'{dt.datetime.now():%Y-%m-%d %H:%M:%S} {stage_error!r}'
+
+    with _status_lock:
+        status['stage_errors'] = {**status['stage_errors'], name: error}
+
+
+def health(now=None):
+
+    # Lag: how far the published run is behind the run Open-Meteo is currently serving.
+    # Issue times are UTC, so the age is taken against UTC too.
+    now = utc_time(now)
+    with _status_lock:
+        report = dict(status)
+
+    published = report['published_issue_time'] or latest_issue_time()
+    expected = forecast_issue_time(now)
+    report['published_issue_time'] = published
+    report['expected_issue_time'] = expected
+    report['lag_runs'] = None if published is None else \
+        int((expected - published) / dt.timedelta(hours=FORECAST_RUN_INTERVAL_HOURS))
+    report['snapshot_age_hours'] = None if published is None else (now - published) / dt.timedelta(hours=1)
+    report['running'] = _thread is not None and _thread.is_alive()
+    report['healthy'] = report['running'] and report['lag_runs'] == 0
+
+    return report
+
+
+def trigger():
+
+    # Manual refresh: wake the scheduler instead of waiting for the next poll
+    _wake.set()
+
+
+def run_forever(poll_interval=POLL_INTERVAL_SECONDS):
+
+    with _status_lock:
+        status['started'] = dt.datetime.now()
+
+    while True:
+        ok = refresh()
+        _wake.wait(poll_interval if ok else min(poll_interval, RETRY_INTERVAL_SECONDS))
+        _wake.clear()
+
+
+def start_scheduler(poll_interval=POLL_INTERVAL_SECONDS):
+
+    # One daemon thread per server process, pages call this on every rerun
+    global _thread
+    with _status_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=run_forever, args=(poll_interval,),
+                                       name='forecast-refresh', daemon=True)
+            _thread.start()
+
+    return _thread
+
+
+if __name__ == '__main__':
+    # Separate worker: python Code/Andras/app/refresh_scheduler.py [--once]
+    if '--once' in sys.argv[1:]:
+        print('refreshed' if refresh() else f'failed: {status["last_error"]}')
+    else:
+        run_forever()
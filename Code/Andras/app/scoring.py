@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import threading
+import numpy as np
+import pandas as pd
+from model_registry import get_pipeline, NativePipeline
+
+# Threads used by the compiled boosters (0 lets XGBoost use every core)
+SCORING_THREADS = int(os.environ.get('SCORING_THREADS', 0))
+
+# Largest difference to the sklearn predict_proba path we accept from a compiled scorer
+PARITY_TOLERANCE = 1e-5
+
+_scorers = {}
+_lock = threading.Lock()
+
+
+def scaler_parameters(pipeline):
+
+    # Mean and scale of the StandardScaler step, for both pickled and native pipelines
+    if isinstance(pipeline, NativePipeline):
+        return pipeline.mean_, pipeline.scale_, pipeline.booster
+
+    scaler, classifier = pipeline.steps[0][1], pipeline.steps[-1][1]
+
+    return scaler.mean_, scaler.scale_, classifier.get_booster()
+
+
+class CompiledScorer:
+
+    # Scores a contiguous float32 matrix (columns in feature_names order) straight on the
+    # booster, without the DataFrame validation and copies of the sklearn pipeline
+
+    def __init__(self, pipeline, nthread=SCORING_THREADS):
+        mean, scale, booster = scaler_parameters(pipeline)
+
+        self.feature_names = [str(name) for name in pipeline.feature_names_in_]
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+
+        # Own copy, so the thread setting does not change the shared pipeline
+        self.booster = booster.copy()
+        self.booster.set_param({'nthread': nthread})
+
+    def score(self, X):
+        # Same arithmetic as the StandardScaler step, then the float32 block XGBoost works on
+        scaled = ((X - self.mean) / self.scale).astype(np.float32)
+
+        return self.booster.inplace_predict(scaled)
+
+
+def feature_matrix(frame, columns):
+
+    # Contiguous float32 block in the column order the booster expects
+    return np.ascontiguousarray(frame[list(columns)].to_numpy(dtype=np.float32))
+
+
+def get_scorer(pickle_path):
+
+    # Compiled once per process, like the pipelines in the model registry
+    if pickle_path not in _scorers:
+        with _lock:
+            if pickle_path not in _scorers:
+                _scorers[pickle_path] = CompiledScorer(get_pipeline(pickle_path))
+
+    return _scorers[pickle_path]
+
+
+def sample_inputs(pipeline, n_rows, seed=0):
+
+    # Random inputs spread around the training distribution of every feature
+    mean, scale, _ = scaler_parameters(pipeline)
+    rng = np.random.default_rng(seed)
+    values = mean + 3 * scale * rng.standard_normal((n_rows, len(mean)))
+
+    # Rounded to float32 first, so both paths see exactly the same values
+    return pd.DataFrame(values.astype(np.float32).astype(np.float64), columns=list(pipeline.feature_names_in_))
+
+
+def parity_check(pickle_path, n_rows=100_000):
+
+    # Compare the compiled scorer against the sklearn predict_proba path
+    pipeline = get_pipeline(pickle_path)
+    scorer = get_scorer(pickle_path)
+    inputs = sample_inputs(pipeline, n_rows)
+
+    expected = pipeline.predict_proba(inputs)[:,1]
+    compiled = scorer.score(feature_matrix(inputs, scorer.feature_names))
+    max_difference = float(np.abs(expected - compiled).max())
+
+    return {'rows': n_rows, 'max_difference': max_difference, 'ok': max_difference <= PARITY_TOLERANCE}
+
+
+def rows_per_second(pickle_path, n_rows=1_000_000, batch_rows=3600, repeats=3):
+
+    # Throughput of the sklearn path and the compiled path on the same inputs,
+    # scored in batches the size of a prediction chunk (default: one grid day)
+    pipeline = get_pipeline(pickle_path)
+    scorer = get_scorer(pickle_path)
+    inputs = sample_inputs(pipeline, n_rows)
+    X = feature_matrix(inputs, scorer.feature_names)
+    batches = range(0, n_rows, batch_rows)
+
+    timings = {}
+    for name, run in [('sklearn', lambda: [pipeline.predict_proba(inputs.iloc[i:i + batch_rows]) for i in batches]),
+                      ('compiled', lambda: [scorer.score(X[i:i + batch_rows]) for i in batches])]:
+        best = min(timed(run) for _ in range(repeats))
+        timings[name] = n_rows / best
+
+    return timings
+
+
+def timed(run):
+
+    start = time.perf_counter()
+    run()
+
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    # Parity and throughput report, e.g.:
+    #     python Code/Andras/app/scoring.py Code/Andras/xgb_building_pipeline.pickle Code/Andras/xgb_tree_pipeline.pickle
+    for path in sys.argv[1:]:
+        parity = parity_check(path)
+        speed = rows_per_second(path)
+        print(f'{path}: max difference {parity["max_difference"]:.2e} ({"ok" if parity["ok"] else "FAILED"}), '
+              f'sklearn {speed["sklearn"]:,.0f} rows/s, compiled {speed["compiled"]:,.0f} rows/s')
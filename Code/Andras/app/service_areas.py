@@ -0,0 +1,149 @@
+import os
+import sys
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+import numpy as np
+import shapely
+from functions import read_geometry_table, WKB_SUFFIX
+from instrumentation import traced
+
+# Cell -> service area membership, next to model_data.sqlite
+INDEX_PATH = "Code/data/service_area_index.npz"
+
+# Overlaps smaller than this share of a cell are boundary noise and dropped
+MIN_FRACTION = 1e-4
+
+# Tables and columns the cell -> area assignment depends on, the grid alone for the
+# prediction cube and map layers
+INDEX_TABLES = [('AMS_grid_blocks', ['geometry']), ('Firestations', ['Service area', 'Service area geometry'])]
+GRID_TABLES = INDEX_TABLES[:1]
+
+_indexes = {}
+_grid_fingerprints = {}
+_lock = threading.Lock()
+
+
+def source_columns(conn, table, columns):
+
+    # Geometry is hashed in the stored form, the WKB copy when there is one
+    available = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+
+    return [column + WKB_SUFFIX if column + WKB_SUFFIX in available else column for column in columns]
+
+
+def tables_fingerprint(database_path, tables=INDEX_TABLES):
+
+    # Content hash of the given columns, by default everything the assignment depends on:
+    # the grid cells (in cell_id order) and the service area names and polygons
+    digest = hashlib.sha256()
+    with closing(sqlite3.connect(database_path)) as conn:
+        for table, columns in tables:
+            selected = ', '.join(f'"{column}"' for column in source_columns(conn, table, columns))
+            for row in conn.execute(f'SELECT {selected} FROM "{table}" ORDER BY rowid'):
+                for value in row:
+                    digest.update(value if isinstance(value, bytes) else str(value).encode())
+                    digest.update(b'\0')
+
+    return digest.hexdigest()[:16]
+
+
+def file_signature(database_path):
+
+    stat = os.stat(database_path)
+
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+def grid_fingerprint(database_path="Code/data/model_data.sqlite"):
+
+    # Content hash of the grid cells, hashed again only when the database file changed
+    signature = file_signature(database_path)
+    with _lock:
+        stored = _grid_fingerprints.get(database_path)
+        if stored is None or not np.array_equal(stored[0], signature):
+            stored = (signature, tables_fingerprint(database_path, GRID_TABLES))
+            _grid_fingerprints[database_path] = stored
+
+    return stored[1]
+
+
+@traced
+def build_service_area_index(database_path):
+
+    # Read straight from the database, the cached grid may predate the change that triggered this
+    cells = read_geometry_table(database_path, 'AMS_grid_blocks', [], ['geometry'])['geometry'].to_numpy()
+    service_areas = read_geometry_table(database_path, 'Firestations', ['Service area'], ['Service area geometry'])
+    areas = service_areas['Service area geometry'].to_numpy()
+
+    # Candidate (cell, area) pairs from an STRtree over the service areas
+    tree = shapely.STRtree(areas)
+    cell_index, area_index = tree.query(cells, predicate='intersects')
+
+    # Cells fully inside an area need no overlay, only boundary cells are intersected
+    fractions = np.ones(len(cell_index))
+    inside = shapely.contains_properly(areas[area_index], cells[cell_index])
+    straddling = ~inside
+    cell_area = shapely.area(cells[cell_index[straddling]])
+    overlap = shapely.area(shapely.intersection(cells[cell_index[straddling]], areas[area_index[straddling]]))
+    fractions[straddling] = np.divide(overlap, cell_area, out=np.zeros_like(overlap), where=cell_area > 0)
+
+    keep = fractions >= MIN_FRACTION
+    order = np.lexsort((area_index[keep], cell_index[keep]))
+
+    return {'cell_id': cell_index[keep][order].astype(np.int32),
+            'area': area_index[keep][order].astype(np.int32),
+            'fraction': fractions[keep][order].astype(np.float32),
+            'area_names': service_areas['Service area'].astype(str).to_numpy(dtype=str),
+            'n_cells': np.int64(len(cells))}
+
+
+def save_index(index, index_path):
+
+    # Written next to the target and swapped in, like the weather archive partitions
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    temporary_path = f'{index_path}.{os.getpid()}.tmp.npz'
+    np.savez(temporary_path, **index)
+    os.replace(temporary_path, index_path)
+
+
+def read_index(index_path):
+
+    if not os.path.exists(index_path):
+        return None
+    with np.load(index_path, allow_pickle=False) as stored:
+        return {key: stored[key] for key in stored.files}
+
+
+def load_service_area_index(database_path="Code/data/model_data.sqlite", index_path=INDEX_PATH):
+
+    # The stored index is reused while the database file is unchanged. When the file did
+    # change, the tables are hashed and the index is only rebuilt if the grid or the
+    # service areas differ (other tables may have been written).
+    signature = file_signature(database_path)
+    key = (database_path, index_path)
+    with _lock:
+        if key in _indexes and np.array_equal(_indexes[key]['signature'], signature):
+            return _indexes[key]
+
+        index = read_index(index_path)
+        if index is None or not np.array_equal(index['signature'], signature):
+            fingerprint = tables_fingerprint(database_path)
+            if index is None or str(index['fingerprint']) != fingerprint:
+                index = build_service_area_index(database_path)
+                index['fingerprint'] = np.array(fingerprint)
+            index['signature'] = signature
+            save_index(index, index_path)
+
+        _indexes[key] = index
+
+    return index
+
+
+if __name__ == '__main__':
+    # Rebuild on demand, e.g. python Code/Andras/app/service_areas.py Code/data/model_data.sqlite
+    database_path = sys.argv[1] if len(sys.argv) > 1 else "Code/data/model_data.sqlite"
+    index = load_service_area_index(database_path)
+    print(f'{len(index["cell_id"])} cell/area pairs for {int(index["n_cells"])} cells and '
+          f'{len(index["area_names"])} service areas ({index["fingerprint"]})')
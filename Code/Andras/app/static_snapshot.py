@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import shapely
+from migrate_geometry_wkb import GEOMETRY_COLUMNS, WKB_SUFFIX
+
+# Columnar copy of the static tables (grid and fire stations) of model_data.sqlite: one .npy
+# file per column, opened memory-mapped, so no worker process reads the tables from SQLite.
+# Only the numeric columns are used straight from the shared pages; text columns are copied
+# into objects and geometry is decoded from WKB once in every process.
+#
+# Usage (from the repository root), normally not needed as the first reader builds it:
+#     python Code/Andras/app/static_snapshot.py [Code/data/model_data.sqlite]
+SNAPSHOT_DIR = "Code/data/static_snapshot"
+
+# Part of the snapshot name, snapshots written in an earlier layout are rebuilt
+SNAPSHOT_FORMAT = 2
+
+_snapshots = {}
+_geometries = {}
+_lock = threading.Lock()
+
+
+def snapshot_name(database_path):
+
+    # A snapshot belongs to one state of the database file
+    stat = os.stat(database_path)
+
+    return f'{os.path.splitext(os.path.basename(database_path))[0]}_v{SNAPSHOT_FORMAT}_{stat.st_size}_{stat.st_mtime_ns}'
+
+
+def write_column(path, values):
+
+    # Text is stored fixed width with a mask for missing values, numbers as they are
+    if values.dtype.kind in 'biufM':
+        np.save(path, np.ascontiguousarray(values))
+        return 'array'
+
+    missing = pd.isna(values)
+    np.save(path, np.where(missing, '', values.astype(object)).astype(str))
+    if missing.any():
+        np.save(path.replace('.npy', '.missing.npy'), missing)
+        return 'text_missing'
+
+    return 'text'
+
+
+def write_geometry(path, geometry):
+
+    # WKB as one fixed width bytes array, so the whole column is decoded by one from_wkb call.
+    # Numpy cuts trailing zero bytes off such values, the lengths are kept to restore them.
+    wkb = shapely.to_wkb(geometry)
+    lengths = np.array([0 if value is None else len(value) for value in wkb], dtype=np.int64)
+    np.save(path, np.where(lengths > 0, wkb, b'').astype(np.bytes_))
+    np.save(path.replace('.npy', '.lengths.npy'), lengths)
+
+    return 'wkb_fixed'
+
+
+def write_table(conn, table, geometry_columns, table_dir):
+
+    available = [row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')]
+    stored = [column for column in available if not column.endswith(WKB_SUFFIX)]
+    table_data = pd.read_sql('SELECT ' + ', '.join(f'"{c}"' for c in available) + f' FROM "{table}" ORDER BY rowid', conn)
+
+    os.makedirs(table_dir)
+    columns = {}
+    for position, column in enumerate(stored):
+        path = os.path.join(table_dir, f'{position}.npy')
+        if column in geometry_columns:
+            if column + WKB_SUFFIX in available:
+                geometry = shapely.from_wkb(table_data[column + WKB_SUFFIX].to_numpy())
+            else:
+                geometry = shapely.from_wkt(table_data[column].to_numpy())
+            kind = write_geometry(path, geometry)
+        else:
+            kind = write_column(path, table_data[column].to_numpy())
+        columns[column] = {'file': f'{position}.npy', 'kind': kind}
+
+    return {'rows': len(table_data), 'columns': columns}
+
+
+def build_snapshot(database_path, snapshot_dir=SNAPSHOT_DIR):
+
+    # Written to a private directory and renamed into place; when another worker got there
+    # first its snapshot is used
+    path = os.path.join(snapshot_dir, snapshot_name(database_path))
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+
+    with sqlite3.connect(database_path) as conn:
+        manifest = {'database': os.path.abspath(database_path),
+                    'tables': {table: write_table(conn, table, geometry_columns, os.path.join(temporary_path, table))
+                               for table, geometry_columns in GEOMETRY_COLUMNS.items()}}
+
+    with open(os.path.join(temporary_path, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+    try:
+        os.rename(temporary_path, path)
+    except OSError:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            raise
+
+    # Snapshots of earlier database states are no longer read (open maps stay valid)
+    prefix = os.path.splitext(os.path.basename(database_path))[0] + '_'
+    for name in os.listdir(snapshot_dir):
+        if name.startswith(prefix) and name != os.path.basename(path) and not name.endswith('.tmp'):
+            shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
+
+    return path
+
+
+def open_snapshot(database_path, snapshot_dir=SNAPSHOT_DIR):
+
+    # Memory-mapped columns of the snapshot matching the current database file, built on
+    # first use. None when it can not be built (e.g. a read-only data directory).
+    try:
+        path = os.path.join(snapshot_dir, snapshot_name(database_path))
+    except OSError:
+        return None
+
+    key = (os.path.abspath(database_path), snapshot_dir)
+    with _lock:
+        if key in _snapshots and _snapshots[key][0] == path:
+            return _snapshots[key][1]
+
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            try:
+                os.makedirs(snapshot_dir, exist_ok=True)
+                build_snapshot(database_path, snapshot_dir)
+            except (OSError, sqlite3.Error):
+                return None
+
+        with open(os.path.join(path, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        snapshot = {}
+        for table, description in manifest['tables'].items():
+            arrays = {column: (stored['kind'], np.load(os.path.join(path, table, stored['file']), mmap_mode='r'))
+                      for column, stored in description['columns'].items()}
+            snapshot[table] = {'path': os.path.join(path, table), 'rows': description['rows'],
+                               'columns': description['columns'], 'arrays': arrays}
+
+        # Replaces (and so releases the maps of) the snapshot of an earlier database state
+        if key in _snapshots:
+            for geometry_key in [k for k in _geometries if k[0].startswith(_snapshots[key][0] + os.sep)]:
+                del _geometries[geometry_key]
+        _snapshots[key] = (path, snapshot)
+
+    return snapshot
+
+
+def column_values(table_snapshot, column):
+
+    kind, values = table_snapshot['arrays'][column]
+    if kind == 'array':
+        return values
+
+    if kind == 'wkb_fixed':
+        return geometry_values(table_snapshot, column)
+
+    values = np.asarray(values).astype(object)
+    if kind == 'text_missing':
+        stored = table_snapshot['columns'][column]['file']
+        missing = np.load(os.path.join(table_snapshot['path'], stored.replace('.npy', '.missing.npy')))
+        values[missing] = None
+
+    return values
+
+
+def geometry_values(table_snapshot, column):
+
+    # Decoded once per process (geometries can not live in the maps); shapely geometries are
+    # immutable, so the array is shared by the threads of the process
+    key = (table_snapshot['path'], column)
+    with _lock:
+        if key not in _geometries:
+            _, stored_wkb = table_snapshot['arrays'][column]
+            stored = table_snapshot['columns'][column]['file']
+            lengths = np.load(os.path.join(table_snapshot['path'], stored.replace('.npy', '.lengths.npy')))
+            wkb = stored_wkb.astype(object)
+            for row in np.flatnonzero(np.char.str_len(stored_wkb) != lengths).tolist():
+                wkb[row] = wkb[row] + b'\0' * (lengths[row] - len(wkb[row]))
+            wkb[lengths == 0] = None
+            _geometries[key] = shapely.from_wkb(wkb)
+
+    return _geometries[key]
+
+
+def snapshot_table(database_path, table, columns, geometry_columns):
+
+    # The requested columns straight from the maps (numbers are not copied), or None when
+    # the table is not in the snapshot and has to be read from SQLite
+    snapshot = open_snapshot(database_path)
+    if snapshot is None or table not in snapshot:
+        return None
+
+    table_snapshot = snapshot[table]
+    selected = list(columns) + list(geometry_columns)
+    if any(column not in table_snapshot['arrays'] for column in selected):
+        return None
+
+    return pd.DataFrame({column: column_values(table_snapshot, column) for column in selected},
+                        index=pd.RangeIndex(table_snapshot['rows']), copy=False)
+
+
+if __name__ == '__main__':
+    database_path = sys.argv[1] if len(sys.argv) > 1 else 'Code/data/model_data.sqlite'
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    print(f'snapshot written to {build_snapshot(database_path)}')
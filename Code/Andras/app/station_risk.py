@@ -0,0 +1,93 @@
+import threading
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from service_areas import load_service_area_index
+from functions import read_geometry_table, daily_aggregate, total_probability
+from instrumentation import traced
+
+PROBA_COLUMNS = ['building_proba', 'tree_proba']
+
+# Daily weather at the centre of every service area, shown next to its risk
+AREA_WEATHER_AGGREGATIONS = {'Precipitation (mm)': ('precipitation', 'sum'),
+                             'Maximum wind gust (m/s)': ('wind_gusts_10m', 'max')}
+
+_matrices = {}
+_lock = threading.Lock()
+
+
+def membership_matrix(index):
+
+    # (stations x cells) CSR matrix holding the share of every cell in each service area
+    key = str(index['fingerprint'])
+    with _lock:
+        if key not in _matrices:
+            _matrices.clear()
+            shape = (len(index['area_names']), int(index['n_cells']))
+            _matrices[key] = sparse.csr_matrix(
+                (index['fraction'].astype(np.float64), (index['area'], index['cell_id'])), shape=shape)
+
+    return _matrices[key]
+
+
+def prediction_matrix(prediction_df, n_cells):
+
+    # Dense (cells x periods) block per probability column, side by side, so all of them
+    # are aggregated by one multiply. Cells without a prediction contribute nothing.
+    periods, period_codes = np.unique(prediction_df['date'].to_numpy(), return_inverse=True)
+    cell_ids = prediction_df['cell_id'].to_numpy()
+
+    block = np.zeros((n_cells, len(PROBA_COLUMNS) * len(periods)))
+    for k, column in enumerate(PROBA_COLUMNS):
+        block[cell_ids, k * len(periods) + period_codes] = prediction_df[column].to_numpy()
+
+    return periods, block
+
+
+def station_vehicles(database_path):
+
+    # Vehicle count per row of the Firestations table, the rows the index areas refer to
+    stations = read_geometry_table(database_path, 'Firestations', ['Service area', 'Vehicle Count'], [])
+
+    return pd.to_numeric(stations['Vehicle Count'], errors='coerce').to_numpy(dtype=np.float64)
+
+
+@traced
+def area_weather(location_data):
+
+    # Long (location, variable, hour) rows of the multi-location forecast -> daily values per area
+    hourly = location_data.pivot(index=['location', 'timestamp'], columns='variable', values='value')
+    hourly.columns = hourly.columns.astype(str)
+    daily = daily_aggregate(hourly.reset_index(), AREA_WEATHER_AGGREGATIONS, by='location')
+
+    return daily.rename_axis(['Service area', 'date']).reset_index().astype({'Service area': str})
+
+
+@traced
+def station_risk(prediction_df, location_data=None, database_path="Code/data/model_data.sqlite"):
+
+    # Expected number of damage events per station and period: membership @ predictions
+    index = load_service_area_index(database_path)
+    membership = membership_matrix(index)
+    periods, block = prediction_matrix(prediction_df, membership.shape[1])
+
+    expected = membership @ block
+    n_stations, n_periods = len(index['area_names']), len(periods)
+    building, tree = expected[:, :n_periods], expected[:, n_periods:]
+
+    vehicles = station_vehicles(database_path)
+    total = total_probability(building, tree)
+
+    risk = pd.DataFrame({'Service area': np.repeat(index['area_names'], n_periods),
+                         'date': np.tile(periods, n_stations),
+                         'expected_building_damage': building.ravel(),
+                         'expected_tree_damage': tree.ravel(),
+                         'expected_incidents': total.ravel(),
+                         'Vehicle Count': np.repeat(vehicles, n_periods)})
+    risk['incidents_per_vehicle'] = risk['expected_incidents'] / risk['Vehicle Count'].where(risk['Vehicle Count'] > 0)
+
+    # Local weather of the service areas, from one batched forecast request for all of them
+    if location_data is not None:
+        risk = risk.merge(area_weather(location_data), on=['Service area', 'date'], how='left')
+
+    return risk
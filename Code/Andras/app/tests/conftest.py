@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app modules import each other by name, as when streamlit runs the app directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+from functions import daily_aggregate, convert_to_daily, DAILY_AGGREGATIONS
+
+LOCATIONS = ['Centrum', 'Noord', 'West']
+
+
+def baseline_convert_to_daily(result):
+
+    # convert_to_daily as it was before daily_aggregate (groupby on the date of the timestamp)
+    result = result.copy()
+    result['date'] = result['timestamp'].dt.date
+    grouped_result = result.groupby('date')
+
+    return pd.DataFrame({'avg_precipitation': grouped_result["precipitation"].mean(),
+                         'avg_windspeed': grouped_result["wind_speed_10m"].mean(),
+                         'max_windspeed': grouped_result["wind_speed_10m"].max(),
+                         'avg_strong_windspeed': grouped_result["wind_speed_10m"].apply(lambda x: np.average(x > 15))})
+
+
+def hourly_frame(timestamps, seed=0):
+
+    # One hourly series per location, with some missing hours
+    rng = np.random.default_rng(seed)
+    n = len(timestamps) * len(LOCATIONS)
+    frame = pd.DataFrame({'location': np.repeat(LOCATIONS, len(timestamps)),
+                          'timestamp': np.tile(timestamps, len(LOCATIONS)),
+                          'precipitation': rng.random(n) * 3,
+                          'wind_speed_10m': rng.random(n) * 25})
+    frame.loc[rng.random(n) < 0.05, ['precipitation', 'wind_speed_10m']] = np.nan
+
+    return frame
+
+
+# From 20:00 UTC, so every series starts and ends on a partial day. The local
+# (Europe/Amsterdam) series also cross the end of summer time on 25 October.
+START = pd.Timestamp('2026-10-23 20:00')
+TIMESTAMPS = {'naive UTC': pd.date_range(START, periods=80, freq='h'),
+              'aware UTC': pd.date_range(START.tz_localize('UTC'), periods=80, freq='h'),
+              'local': pd.date_range(START.tz_localize('UTC'), periods=80, freq='h').tz_convert('Europe/Amsterdam')}
+
+
+@pytest.mark.parametrize('name', list(TIMESTAMPS))
+def test_daily_aggregate_matches_baseline_per_location(name):
+
+    frame = hourly_frame(TIMESTAMPS[name])
+    expected = pd.concat({location: baseline_convert_to_daily(group)
+                          for location, group in frame.groupby('location')}, names=['location', 'date'])
+
+    daily = daily_aggregate(frame, DAILY_AGGREGATIONS, by='location')
+
+    pd.testing.assert_frame_equal(daily.sort_index(), expected.sort_index(), check_dtype=False)
+
+
+@pytest.mark.parametrize('name', list(TIMESTAMPS))
+def test_convert_to_daily_matches_baseline(name):
+
+    frame = hourly_frame(TIMESTAMPS[name], seed=1)
+    frame = frame[frame['location'] == LOCATIONS[0]].drop(columns='location').reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(convert_to_daily(frame), baseline_convert_to_daily(frame), check_dtype=False)
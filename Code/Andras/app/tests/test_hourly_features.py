@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+from hourly_features import window_sums, window_maxima
+
+
+def series_with_gaps(n, seed=0):
+
+    # Random hourly values with single missing hours and a longer gap
+    rng = np.random.default_rng(seed)
+    values = rng.random(n) * 30
+    values[rng.random(n) < 0.05] = np.nan
+    values[n // 3:n // 3 + 5] = np.nan
+
+    return values
+
+
+@pytest.mark.parametrize('n', [0, 1, 5, 23, 24, 25, 200, 1000])
+@pytest.mark.parametrize('window', [1, 3, 24, 72])
+def test_window_sums_match_rolling_sum(n, window):
+
+    values = series_with_gaps(n)
+    expected = pd.Series(values, dtype=np.float64).rolling(window).sum().to_numpy()
+
+    np.testing.assert_allclose(window_sums(values, window), expected, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('n', [0, 1, 5, 23, 24, 25, 200, 1000])
+@pytest.mark.parametrize('window', [1, 3, 24, 72])
+def test_window_maxima_match_rolling_max(n, window):
+
+    values = series_with_gaps(n, seed=1)
+    expected = pd.Series(values, dtype=np.float64).rolling(window).max().to_numpy()
+
+    np.testing.assert_array_equal(window_maxima(values, window), expected)
+
+
+def test_windows_shorter_series_are_all_missing():
+
+    values = np.arange(10, dtype=np.float64)
+
+    assert np.isnan(window_sums(values, 24)).all()
+    assert np.isnan(window_maxima(values, 24)).all()
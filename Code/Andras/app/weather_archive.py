@@ -0,0 +1,163 @@
+import os
+import sys
+import threading
+import datetime as dt
+import numpy as np
+import pandas as pd
+from functions import fetch_openmeteo_historical
+
+# Append-only hourly archive: one float32 .npy file per location, variable and month,
+# indexed by the hour since the start of the month (UTC, like the Open-Meteo timestamps)
+ARCHIVE_DIR = "Code/data/weather_archive"
+
+# Where the archive starts when nothing has been stored yet
+BACKFILL_START = '2024-01-01'
+
+LOCATIONS = {'amsterdam': (52.374, 4.890)}
+
+DEFAULT_PARAMETERS = ['precipitation', 'wind_speed_10m', 'wind_gusts_10m']
+
+# Pages top up the archive at most this often per process
+UPDATE_INTERVAL = pd.Timedelta(hours=1)
+
+_last_update = {}
+
+
+def partition_path(location, variable, month):
+
+    return os.path.join(ARCHIVE_DIR, location, variable, f'{month:%Y-%m}.npy')
+
+
+def hours_in_month(month):
+
+    return month.days_in_month * 24
+
+
+def read_partition(location, variable, month):
+
+    path = partition_path(location, variable, month)
+    if not os.path.exists(path):
+        return None
+
+    return np.load(path, mmap_mode='r')
+
+
+def write_partition(location, variable, month, values):
+
+    # Write next to the target and swap it in, so readers never see half a file. The
+    # temporary name is per thread, the page and the scheduler may write at the same time.
+    path = partition_path(location, variable, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary_path, 'wb') as handle:
+        np.save(handle, values)
+    os.replace(temporary_path, path)
+
+
+def last_stored_hour(location, variable):
+
+    # Last hour with a value in the newest partition of this variable
+    directory = os.path.join(ARCHIVE_DIR, location, variable)
+    if not os.path.isdir(directory):
+        return None
+
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith('.npy'):
+            continue
+        month = pd.Timestamp(name[:-len('.npy')])
+        stored = np.flatnonzero(~np.isnan(read_partition(location, variable, month)))
+        if len(stored):
+            return month + pd.Timedelta(hours=int(stored[-1]))
+
+    return None
+
+
+def store_hourly(location, hourly_data, list_of_parameters):
+
+    # Split the hourly frame into month partitions and merge it into the stored values
+    timestamps = pd.DatetimeIndex(hourly_data['timestamp'])
+    months = timestamps.to_period('M').to_timestamp()
+
+    for month in months.unique():
+        in_month = np.asarray(months == month)
+        offsets = ((timestamps[in_month] - month) // pd.Timedelta(hours=1)).to_numpy()
+
+        for variable in list_of_parameters:
+            stored = read_partition(location, variable, month)
+            values = np.full(hours_in_month(month), np.nan, dtype=np.float32) if stored is None else np.array(stored)
+
+            # The map has to be closed before the file is replaced (Windows refuses otherwise)
+            del stored
+
+            # New values only fill in, a missing (NaN) value never overwrites a stored one
+            new_values = hourly_data[variable].to_numpy(dtype=np.float32)[in_month]
+            keep = ~np.isnan(new_values)
+            values[offsets[keep]] = new_values[keep]
+
+            write_partition(location, variable, month, values)
+
+
+def update_archive(list_of_parameters=DEFAULT_PARAMETERS, location='amsterdam', end_date=None,
+                   backfill_start=BACKFILL_START):
+
+    if end_date is None:
+        end_date = dt.date.today()
+
+    # Only fetch the gap between the oldest "last stored hour" of the variables and now
+    last_hours = [last_stored_hour(location, variable) for variable in list_of_parameters]
+    if any(hour is None for hour in last_hours):
+        start_date = pd.Timestamp(backfill_start).date()
+    else:
+        start_date = (min(last_hours) + pd.Timedelta(hours=1)).date()
+
+    if start_date > end_date:
+        return None
+
+    latitude, longitude = LOCATIONS[location]
+    hourly_data = fetch_openmeteo_historical(list_of_parameters, str(start_date), str(end_date), latitude, longitude)
+    store_hourly(location, hourly_data, list_of_parameters)
+
+    return start_date, end_date
+
+
+def read_archive(list_of_parameters=DEFAULT_PARAMETERS, start_date=BACKFILL_START, end_date=None, location='amsterdam'):
+
+    # Hourly frame in the same layout as openmeteo_historical_data, served from disk
+    if end_date is None:
+        end_date = dt.date.today()
+    timestamps = pd.date_range(pd.Timestamp(start_date), pd.Timestamp(end_date) + pd.Timedelta(days=1),
+                               freq='h', inclusive='left')
+    months = timestamps.to_period('M').to_timestamp()
+
+    historical_data = pd.DataFrame({'timestamp': timestamps})
+    for variable in list_of_parameters:
+        values = np.full(len(timestamps), np.nan, dtype=np.float32)
+        for month in months.unique():
+            stored = read_partition(location, variable, month)
+            if stored is None:
+                continue
+            in_month = np.asarray(months == month)
+            offsets = ((timestamps[in_month] - month) // pd.Timedelta(hours=1)).to_numpy()
+            values[in_month] = stored[offsets]
+        historical_data[variable] = values
+
+    return historical_data
+
+
+def archived_historical_data(list_of_parameters=DEFAULT_PARAMETERS, start_date=BACKFILL_START, end_date=None,
+                             location='amsterdam'):
+
+    # Top up the archive with the hours since the last update, then serve the range from disk
+    key = (location, tuple(list_of_parameters))
+    now = pd.Timestamp.now()
+    if key not in _last_update or now - _last_update[key] > UPDATE_INTERVAL:
+        update_archive(list_of_parameters, location)
+        _last_update[key] = now
+
+    return read_archive(list_of_parameters, start_date, end_date, location)
+
+
+if __name__ == '__main__':
+    # One-off backfill, e.g. python Code/Andras/app/weather_archive.py 2015-01-01
+    backfill_start = sys.argv[1] if len(sys.argv) > 1 else BACKFILL_START
+    print(update_archive(backfill_start=backfill_start))